@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+"""Per-worker pool of CUPS connections.
+
+Opening a ``cups.Connection`` costs a full handshake with the CUPS server,
+which is expensive on remote hosts. Connections are kept in a pool keyed by
+``(address, port)``, shared by every ``printing.server`` record of the
+current worker process, and borrowed for the duration of each CUPS call.
+
+Each pool also carries a circuit breaker: once a server failed to accept
+connections several times in a row, it is not contacted anymore during a
+backoff window, and callers fail fast instead of waiting for the connection
+to time out.
+
+Connecting and calling CUPS are bounded in time by `call_with_timeout`, as
+pycups itself offers no way to time out a request.
+
+`run_parallel` spreads requests to several servers over a bounded set of
+threads, and `stream_parallel` does the same for requests producing their
+results piece by piece. These threads must only talk to CUPS: the database
+work stays in the thread owning the cursor.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_logger = logging.getLogger(__name__)
+
+# Maximum number of simultaneously opened connections per CUPS server
+POOL_MAX_SIZE = 8
+# Seconds to wait for a connection when the pool is exhausted
+POOL_WAIT_TIMEOUT = 30
+# Idle connections unused for that many seconds are closed
+POOL_IDLE_TIMEOUT = 300
+# Idle connections unused for that many seconds are checked before reuse
+POOL_CHECK_INTERVAL = 30
+# Consecutive connection failures opening the circuit breaker
+BREAKER_THRESHOLD = 3
+# Seconds during which a server is not contacted after the breaker opened
+BREAKER_BACKOFF = 30
+# Upper limit of the backoff window, doubled after each failed probe
+BREAKER_MAX_BACKOFF = 600
+# Maximum number of threads used to contact several servers at the same time
+PARALLEL_MAX_WORKERS = 8
+# Maximum number of results produced ahead of their processing by a stream
+STREAM_QUEUE_SIZE = 4
+
+
+class PoolExhausted(Exception):
+    """ No connection could be borrowed from the pool in time """
+
+
+class ServerUnavailable(Exception):
+    """ The circuit breaker of the server is open """
+
+    def __init__(self, key, failures, retry_in):
+        super(ServerUnavailable, self).__init__(
+            'CUPS server %s:%s failed %d times, next attempt in %d seconds'
+            % (key + (failures, retry_in)))
+        self.key = key
+        self.failures = failures
+        self.retry_in = retry_in
+
+
+class OperationTimeout(Exception):
+    """ A CUPS request did not complete in time """
+
+
+def _start_thread(function, *args, **kwargs):
+    """ Call `function` in a daemon thread
+
+    Return the thread and a dictionary, where the thread stores the result
+    of the call under ``value``, or the exception it raised under ``error``.
+    """
+    result = {}
+
+    def target():
+        try:
+            result['value'] = function(*args, **kwargs)
+        except Exception as error:
+            result['error'] = error
+
+    thread = threading.Thread(
+        target=target, name='cups-%s' % getattr(function, '__name__', 'call'))
+    thread.daemon = True
+    thread.start()
+    return thread, result
+
+
+def _thread_result(result):
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def call_with_timeout(function, timeout, *args, **kwargs):
+    """ Call `function`, giving up after `timeout` seconds
+
+    The call runs in a daemon thread, which is abandoned on timeout: the
+    caller gets an `OperationTimeout` and whatever the call was using must not
+    be reused. A false `timeout` means no limit.
+    """
+    if not timeout:
+        return function(*args, **kwargs)
+
+    thread, result = _start_thread(function, *args, **kwargs)
+    thread.join(timeout)
+    if thread.is_alive():
+        raise OperationTimeout(
+            '%s did not complete within %s seconds' % (
+                getattr(function, '__name__', 'CUPS call'), timeout))
+    return _thread_result(result)
+
+
+class CircuitBreaker(object):
+    """ Track consecutive failures of a server
+
+    The breaker is closed while the server answers. After `threshold`
+    consecutive failures, it opens and refuses any attempt for `backoff`
+    seconds. Then it becomes half-open: a single probe is let through, which
+    either closes the breaker or opens it again for twice as long.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, backoff=BREAKER_BACKOFF,
+                 max_backoff=BREAKER_MAX_BACKOFF):
+        self.threshold = threshold
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.backoff = backoff
+        self.retry_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Return True if the server may be contacted now """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if now < self.retry_at:
+                return False
+            # Let a single probe through, others wait for another window
+            self.state = self.HALF_OPEN
+            self.retry_at = now + self.backoff
+            return True
+
+    def retry_in(self):
+        """ Number of seconds before the next attempt is allowed """
+        return max(0, self.retry_at - time.time())
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.backoff = self.initial_backoff
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.backoff = min(self.backoff * 2, self.max_backoff)
+            elif self.failures < self.threshold:
+                return
+            self.state = self.OPEN
+            self.retry_at = time.time() + self.backoff
+
+
+class ConnectionPool(object):
+    """ Pool of connections to a single CUPS server """
+
+    def __init__(self, key, max_size=POOL_MAX_SIZE,
+                 wait_timeout=POOL_WAIT_TIMEOUT,
+                 idle_timeout=POOL_IDLE_TIMEOUT,
+                 check_interval=POOL_CHECK_INTERVAL):
+        self.key = key
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        # Idle connections, as (connection, last use time), oldest first
+        self._idle = deque()
+        # Number of connections opened by this pool, idle or borrowed
+        self._size = 0
+        self._condition = threading.Condition(threading.Lock())
+        self.breaker = CircuitBreaker()
+
+    def __len__(self):
+        return self._size
+
+    def _evict_idle(self):
+        """ Drop the connections which have been idle for too long
+
+        Must be called with the lock held.
+        """
+        limit = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < limit:
+            self._idle.popleft()
+            self._size -= 1
+
+    def _check(self, connection, timeout=None):
+        """ Cheap request used to ensure an idle connection is still alive """
+        try:
+            call_with_timeout(connection.getDefault, timeout)
+        except Exception:
+            _logger.debug(
+                'Dropping stale CUPS connection to %s:%s', *self.key)
+            return False
+        return True
+
+    def acquire(self, factory, timeout=None):
+        """ Borrow a connection, creating it with `factory` when needed
+
+        Raise `ServerUnavailable` without contacting the server while its
+        circuit breaker is open. `timeout` bounds the health check of idle
+        connections.
+        """
+        if not self.breaker.allow():
+            raise ServerUnavailable(
+                self.key, self.breaker.failures, self.breaker.retry_in())
+        deadline = time.time() + self.wait_timeout
+        connection = last_use = None
+        with self._condition:
+            self._evict_idle()
+            while True:
+                if self._idle:
+                    # Reuse the most recently used connection
+                    connection, last_use = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        'No CUPS connection available for %s:%s' % self.key)
+                self._condition.wait(remaining)
+
+        if connection is not None and \
+                time.time() - last_use < self.check_interval:
+            return connection
+        if connection is not None and self._check(connection, timeout):
+            return connection
+
+        # Open a new connection in the reserved slot
+        try:
+            connection = factory()
+        except Exception:
+            self._release_slot()
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return connection
+
+    def release(self, connection):
+        """ Give a healthy connection back to the pool """
+        if self.breaker.state != CircuitBreaker.CLOSED:
+            self.breaker.success()
+        with self._condition:
+            self._idle.append((connection, time.time()))
+            self._condition.notify()
+
+    def discard(self, connection):
+        """ Forget a borrowed connection, which may be broken """
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def clear(self):
+        """ Close all idle connections """
+        with self._condition:
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._condition.notify_all()
+
+    @contextmanager
+    def connection(self, factory, timeout=None):
+        """ Borrow a connection for the duration of the block
+
+        Connections are discarded instead of being reused when the block
+        raises, as the failure may come from the connection itself.
+        """
+        connection = self.acquire(factory, timeout=timeout)
+        try:
+            yield connection
+        except Exception:
+            self.discard(connection)
+            raise
+        else:
+            self.release(connection)
+
+
+class PooledConnection(object):
+    """ Stand-in for a ``cups.Connection`` backed by a pool
+
+    Each method call borrows a connection from the pool, runs the call on it,
+    then gives it back. Opening a connection is limited to `connect_timeout`
+    seconds, and each call to `call_timeout` seconds. A call timing out
+    counts as a failure of the server for its circuit breaker.
+    """
+
+    def __init__(self, pool, factory, connect_timeout=None,
+                 call_timeout=None):
+        self._pool = pool
+        self._factory = partial(call_with_timeout, factory, connect_timeout)
+        self._call_timeout = call_timeout
+
+    def _call(self, name, *args, **kwargs):
+        def call(connection):
+            return getattr(connection, name)(*args, **kwargs)
+        call.__name__ = name
+        return self.run(call)
+
+    def check(self):
+        """ Ensure a connection to the server can be borrowed """
+        with self._pool.connection(
+                self._factory, timeout=self._call_timeout):
+            pass
+
+    def run(self, function, *args, **kwargs):
+        """ Call `function` with a borrowed connection as first argument
+
+        Needed by the operations spanning several calls, like sending a
+        document by chunks, which must all use the same connection. The
+        whole operation runs in a single thread, and each of its calls is
+        bounded by `call_timeout`: an operation making many calls may last
+        longer. Once a call timed out, the next ones made by the abandoned
+        operation fail at once.
+        """
+        with self._pool.connection(
+                self._factory, timeout=self._call_timeout) as connection:
+            if not self._call_timeout:
+                return function(connection, *args, **kwargs)
+
+            connection = _WatchedConnection(connection)
+            thread, result = _start_thread(
+                function, connection, *args, **kwargs)
+            while True:
+                call = connection._call
+                waited = time.time() - call[1] if call else 0
+                if waited >= self._call_timeout:
+                    connection._abandoned = True
+                    self._pool.breaker.failure()
+                    raise OperationTimeout(
+                        '%s did not complete within %s seconds' % (
+                            call[0], self._call_timeout))
+                thread.join(self._call_timeout - waited)
+                if not thread.is_alive():
+                    return _thread_result(result)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = partial(self._call, name)
+        method.__name__ = name
+        return method
+
+
+class _WatchedConnection(object):
+    """ Stand-in for a borrowed connection, recording the running call
+
+    `_call` holds the name and start time of the call in progress, if any.
+    Once `_abandoned` is set, calls fail without reaching CUPS.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._call = None
+        self._abandoned = False
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self._connection, name)
+
+        def watched(*args, **kwargs):
+            if self._abandoned:
+                raise OperationTimeout(
+                    '%s was called after the operation timed out' % name)
+            self._call = (name, time.time())
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._call = None
+        watched.__name__ = name
+        return watched
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(address, port):
+    """ Return the pool of connections for a CUPS server """
+    key = (address, port)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(key)
+        return pool
+
+
+def clear_pools():
+    """ Close all idle connections and forget all pools """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.clear()
+        _pools.clear()
+
+
+class PrefetchedConnection(object):
+    """ Stand-in for a connection, serving the results of calls made ahead
+
+    `results` maps ``(method name, positional arguments)`` to the
+    ``(result, error)`` of the call. Each prefetched result is served once,
+    any other call is forwarded to `connection`.
+    """
+
+    def __init__(self, connection, results):
+        self._connection = connection
+        self._results = dict(results)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self._connection, name)
+
+        def prefetched(*args, **kwargs):
+            key = (name, args)
+            if kwargs or key not in self._results:
+                return method(*args, **kwargs)
+            result, error = self._results.pop(key)
+            if error is not None:
+                raise error
+            return result
+        prefetched.__name__ = name
+        return prefetched
+
+
+def prefetch(connection, calls):
+    """ Make `calls`, as ``(method name, positional arguments)`` pairs
+
+    Return the results in the format expected by `PrefetchedConnection`.
+    """
+    results = {}
+    for name, args in calls:
+        try:
+            results[name, args] = (getattr(connection, name)(*args), None)
+        except Exception as error:
+            results[name, args] = (None, error)
+    return results
+
+
+def run_parallel(function, arguments, max_workers=PARALLEL_MAX_WORKERS):
+    """ Call `function` with each of `arguments`, from up to `max_workers`
+    threads at the same time
+
+    Return the ``(result, error)`` of each call, in the order of `arguments`.
+    """
+    outcomes = [None] * len(arguments)
+
+    def call(index):
+        try:
+            outcomes[index] = (function(arguments[index]), None)
+        except Exception as error:
+            outcomes[index] = (None, error)
+
+    if len(arguments) <= 1 or max_workers <= 1:
+        for index in range(len(arguments)):
+            call(index)
+        return outcomes
+
+    indexes = iter(range(len(arguments)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                return
+            call(index)
+
+    threads = [
+        threading.Thread(target=worker, name='cups-worker-%d' % number)
+        for number in range(min(max_workers, len(arguments)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def stream_parallel(function, arguments, max_workers=PARALLEL_MAX_WORKERS,
+                    queue_size=STREAM_QUEUE_SIZE):
+    """ Iterate over the items generated by `function` for each of
+    `arguments`, from up to `max_workers` threads at the same time
+
+    Yield ``(index of the argument, item, error)`` tuples, in the order the
+    items are produced. An error stops the iteration for its argument only.
+    Threads wait while `queue_size` items are waiting to be consumed, so
+    that the memory used stays bounded when they produce faster than the
+    items are processed.
+    """
+    if len(arguments) <= 1 or max_workers <= 1:
+        for index, argument in enumerate(arguments):
+            try:
+                for item in function(argument):
+                    yield index, item, None
+            except Exception as error:
+                yield index, None, error
+        return
+
+    results = queue.Queue(queue_size)
+    stopped = threading.Event()
+    done = object()
+    indexes = iter(range(len(arguments)))
+    lock = threading.Lock()
+
+    def put(result):
+        # Give up when the consumer stopped iterating
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def worker():
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                put(done)
+                return
+            try:
+                for item in function(arguments[index]):
+                    if not put((index, item, None)):
+                        return
+            except Exception as error:
+                if not put((index, None, error)):
+                    return
+
+    threads = [
+        threading.Thread(target=worker, name='cups-stream-%d' % number)
+        for number in range(min(max_workers, len(arguments)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            result = results.get()
+            if result is done:
+                running -= 1
+                continue
+            yield result
+    finally:
+        stopped.set()
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from . import ir_actions_report_xml
+from . import ir_property
 from . import printing_action
 from . import printing_job
+from . import printing_job_statistics
 from . import printing_printer
+from . import printing_printer_pool
 from . import printing_server
+from . import printing_spool
 from . import printing_report_xml_action
 from . import report
 from . import res_users
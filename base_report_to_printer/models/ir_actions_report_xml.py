@@ -6,7 +6,15 @@
 # Copyright (C) 2013-2014 Camptocamp (<http://www.camptocamp.com>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import models, fields, api
+from odoo import models, fields, api, tools
+
+
+def _freeze_behaviour(behaviour):
+    """ Return a behaviour holding ids instead of records, to be cached """
+    return tuple(
+        (key, value._name, tuple(value.ids))
+        if isinstance(value, models.BaseModel) else (key, None, value)
+        for key, value in behaviour.items())
 
 
 class IrActionsReportXml(models.Model):
@@ -25,6 +33,11 @@ class IrActionsReportXml(models.Model):
         comodel_name='printing.printer',
         string='Printer'
     )
+    printing_printer_pool_id = fields.Many2one(
+        comodel_name='printing.printer.pool',
+        string='Printer Pool',
+        help='Pool of printers used instead of the printer'
+    )
     printing_action_ids = fields.One2many(
         comodel_name='printing.report.xml.action',
         inverse_name='report_id',
@@ -46,12 +59,60 @@ class IrActionsReportXml(models.Model):
         result = report.behaviour()[report.id]
         serializable_result = {
             'action': result['action'],
-            'printer_name': result['printer'].name,
+            'printer_name': (
+                result['printer_pool'] or result['printer']).name,
         }
         return serializable_result
 
+    @api.model
+    def _printing_behaviour_fields(self):
+        """ Return the fields whose changes modify the printing behaviours """
+        return {
+            'property_printing_action_id',
+            'printing_printer_id',
+            'printing_printer_pool_id',
+        }
+
+    @api.multi
+    def write(self, vals):
+        if set(vals) & self._printing_behaviour_fields():
+            self.clear_caches()
+        return super(IrActionsReportXml, self).write(vals)
+
     @api.multi
     def behaviour(self):
+        """ Return the printing action and printer of the reports
+
+        The behaviours are resolved once per report, user and company, then
+        cached until the printing settings change. The reports missing from
+        the cache are resolved together.
+        """
+        result = {}
+        frozen_behaviours = self._get_frozen_behaviours(self.ids)
+        for report in self:
+            result[report.id] = dict(
+                (key, self.env[model].browse(value) if model else value)
+                for key, model, value in frozen_behaviours[report.id])
+        return result
+
+    @api.model
+    @tools.ormcache_multi(
+        'self._uid', 'self.env.user.company_id.id', multi='report_ids')
+    def _get_frozen_behaviours(self, report_ids):
+        return dict(
+            (report_id, _freeze_behaviour(behaviour))
+            for report_id, behaviour in self.browse(
+                report_ids)._resolve_behaviour().items())
+
+    @api.multi
+    def _resolve_behaviour(self):
+        """ Compute the behaviours returned by `behaviour`, without cache
+
+        The number of queries does not depend on the number of reports:
+        the report-user actions are searched at once, and the fields of the
+        reports, including the company dependent ones, are read for all of
+        them together.
+        """
         result = {}
         printer_obj = self.env['printing.printer']
         printing_act_obj = self.env['printing.report.xml.action']
@@ -59,38 +120,56 @@ class IrActionsReportXml(models.Model):
         default_action = 'client'
         # Retrieve system wide printer
         default_printer = printer_obj.get_default()
+        default_pool = self.env['printing.printer.pool']
 
         # Retrieve user default values
         user = self.env.user
         if user.printing_action:
             default_action = user.printing_action
-        if user.printing_printer_id:
+        # Archived pools are ignored
+        if user.printing_printer_pool_id.active:
+            default_pool = user.printing_printer_pool_id
+        elif user.printing_printer_id:
             default_printer = user.printing_printer_id
 
+        # Retrieve report-user specific values
+        print_actions = {}
+        for print_action in printing_act_obj.search(
+                [('report_id', 'in', self.ids),
+                 ('user_id', '=', self.env.uid),
+                 ('action', '!=', 'user_default')]):
+            print_actions.setdefault(print_action.report_id.id, print_action)
+
         for report in self:
             action = default_action
             printer = default_printer
+            pool = default_pool
 
             # Retrieve report default values
             report_action = report.property_printing_action_id
             if report_action and report_action.action_type != 'user_default':
                 action = report_action.action_type
-            if report.printing_printer_id:
+            if report.printing_printer_pool_id.active:
+                pool = report.printing_printer_pool_id
+            elif report.printing_printer_id:
                 printer = report.printing_printer_id
+                pool = default_pool.browse()
 
-            # Retrieve report-user specific values
-            print_action = printing_act_obj.search(
-                [('report_id', '=', report.id),
-                 ('user_id', '=', self.env.uid),
-                 ('action', '!=', 'user_default')],
-                limit=1)
+            print_action = print_actions.get(report.id)
             if print_action:
                 user_action = print_action.behaviour()
                 action = user_action['action']
-                if user_action['printer']:
+                if user_action['printer_pool'].active:
+                    pool = user_action['printer_pool']
+                elif user_action['printer']:
                     printer = user_action['printer']
+                    pool = default_pool.browse()
 
+            # The printer of a pool is selected when printing
+            if pool:
+                printer = printer_obj
             result[report.id] = {'action': action,
                                  'printer': printer,
+                                 'printer_pool': pool,
                                  }
         return result
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api
+
+
+class IrProperty(models.Model):
+    _inherit = 'ir.property'
+
+    @api.multi
+    def _is_printing_behaviour(self):
+        """ Return True if a property holds a printing setting of reports """
+        report_fields = self.env[
+            'ir.actions.report.xml']._printing_behaviour_fields()
+        return any(
+            prop.fields_id.model == 'ir.actions.report.xml' and
+            prop.fields_id.name in report_fields
+            for prop in self.sudo())
+
+    @api.model
+    def create(self, vals):
+        prop = super(IrProperty, self).create(vals)
+        if prop._is_printing_behaviour():
+            # Company dependent values are part of the cached behaviours
+            self.env['ir.actions.report.xml'].clear_caches()
+        return prop
+
+    @api.multi
+    def write(self, vals):
+        printing_behaviour = self._is_printing_behaviour()
+        res = super(IrProperty, self).write(vals)
+        if printing_behaviour or self._is_printing_behaviour():
+            self.env['ir.actions.report.xml'].clear_caches()
+        return res
+
+    @api.multi
+    def unlink(self):
+        if self._is_printing_behaviour():
+            self.env['ir.actions.report.xml'].clear_caches()
+        return super(IrProperty, self).unlink()
@@ -28,3 +28,15 @@ class PrintingAction(models.Model):
         required=True,
         oldname='type'
     )
+
+    @api.multi
+    def write(self, vals):
+        if 'action_type' in vals:
+            # The action types are part of the cached report behaviours
+            self.clear_caches()
+        return super(PrintingAction, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(PrintingAction, self).unlink()
@@ -3,10 +3,17 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
-from odoo import models, fields, api
+from datetime import datetime
+from operator import itemgetter
+from odoo import models, fields, api, exceptions, _
 
 _logger = logging.getLogger(__name__)
 
+# Number of jobs written by each statement of the bulk upsert
+UPSERT_CHUNK_SIZE = 1000
+# States of the jobs which will not change anymore
+FINAL_JOB_STATES = ('canceled', 'aborted', 'completed')
+
 
 class PrintingJob(models.Model):
     _name = 'printing.job'
@@ -35,6 +42,22 @@ class PrintingJob(models.Model):
         help='Date and time of process for this job.')
     time_at_completed = fields.Datetime(
         help='Date and time of completion for this job.')
+    job_impressions_completed = fields.Integer(
+        string='Pages', help='Number of pages printed for this job.')
+    report_id = fields.Many2one(
+        comodel_name='ir.actions.report.xml', string='Report',
+        ondelete='set null', help='Report which produced this job.')
+    res_model = fields.Char(
+        string='Model', help='Model of the records printed by this job.')
+    res_ids = fields.Char(
+        string='Records',
+        help='Comma separated ids of the records printed by this job.')
+    user_id = fields.Many2one(
+        comodel_name='res.users', string='User', ondelete='set null',
+        help='User who printed this job.')
+    statistics_done = fields.Boolean(
+        readonly=True, copy=False,
+        help='Checked once the job is counted in the printing statistics.')
     job_state = fields.Selection(selection=[
         ('pending', 'Pending'),
         ('pending held', 'Pending Held'),
@@ -86,6 +109,111 @@ class PrintingJob(models.Model):
          'The id of the job must be unique per server !'),
     ]
 
+    @api.model
+    def _prepare_update_from_cups(self, cups_job_id, cups_job):
+        mapping = {
+            3: 'pending',
+            4: 'pending held',
+            5: 'processing',
+            6: 'processing stopped',
+            7: 'canceled',
+            8: 'aborted',
+            9: 'completed',
+        }
+        state_reason = cups_job.get('job-state-reasons', '')
+        if isinstance(state_reason, list):
+            # Only the main reason is kept when CUPS gives several ones
+            state_reason = state_reason[0] if state_reason else False
+        vals = {
+            'name': cups_job.get('job-name', ''),
+            'active': True,
+            'job_id_cups': cups_job_id,
+            'job_media_progress': cups_job.get('job-media-progress', 0),
+            'job_impressions_completed': cups_job.get(
+                'job-impressions-completed', 0),
+            'job_state': mapping.get(cups_job.get('job-state'), 'unknown'),
+            'job_state_reason': state_reason,
+            'time_at_creation': fields.Datetime.to_string(
+                datetime.fromtimestamp(cups_job.get('time-at-creation', 0))),
+            'time_at_processing': cups_job.get(
+                'time-at-processing', 0) and fields.Datetime.to_string(
+                    datetime.fromtimestamp(cups_job.get(
+                        'time-at-processing', 0))),
+            'time_at_completed': cups_job.get(
+                'time-at-completed', 0) and fields.Datetime.to_string(
+                    datetime.fromtimestamp(cups_job.get(
+                        'time-at-completed', 0))),
+        }
+        return vals
+
+    @api.model
+    def _bulk_upsert(self, values_list, update_columns=None):
+        """ Create or update jobs, identified by their CUPS id and server
+
+        All items of `values_list` must have the same keys, which must be
+        stored fields, including ``job_id_cups`` and ``server_id``.
+        Existing jobs only get the `update_columns` written, all the given
+        columns by default.
+        Jobs are written by chunks, with a single ``INSERT ... ON CONFLICT``
+        statement each, which only modifies the jobs whose values changed.
+        This requires PostgreSQL 9.5 or later.
+        Return the ids of the created or modified jobs.
+        """
+        if not values_list:
+            return []
+        self.check_access_rights('create')
+        self.check_access_rights('write')
+
+        columns = sorted(values_list[0])
+        updated_columns = [
+            column for column in columns
+            if column not in ('job_id_cups', 'server_id') and (
+                update_columns is None or column in update_columns)
+        ]
+        row_placeholder = '(%s)' % ', '.join(
+            ["%s, (now() at time zone 'UTC')"] * 2 + ['%s'] * len(columns))
+        query = """
+            INSERT INTO printing_job AS job (
+                create_uid, create_date, write_uid, write_date, {columns})
+            VALUES {rows}
+            ON CONFLICT (job_id_cups, server_id) DO UPDATE SET
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date,
+                {updates}
+            WHERE ({current}) IS DISTINCT FROM ({excluded})
+            RETURNING id
+        """
+
+        # Lock rows always in the same order to avoid deadlocks
+        values_list = sorted(values_list, key=itemgetter('job_id_cups'))
+        ids = []
+        for index in range(0, len(values_list), UPSERT_CHUNK_SIZE):
+            chunk = values_list[index:index + UPSERT_CHUNK_SIZE]
+            params = []
+            for values in chunk:
+                params.extend([self.env.uid, self.env.uid])
+                params.extend(
+                    self._fields[column].convert_to_column(
+                        values[column], self)
+                    for column in columns)
+            self.env.cr.execute(query.format(
+                columns=', '.join(columns),
+                rows=', '.join([row_placeholder] * len(chunk)),
+                updates=', '.join(
+                    '%s = EXCLUDED.%s' % (column, column)
+                    for column in updated_columns),
+                current=', '.join(
+                    'job.%s' % column for column in updated_columns),
+                excluded=', '.join(
+                    'EXCLUDED.%s' % column for column in updated_columns),
+            ), params)
+            ids.extend(row[0] for row in self.env.cr.fetchall())
+
+        # The ORM cache does not know about these changes
+        self.invalidate_cache(ids=ids)
+        self.env['printing.printer'].invalidate_cache(['job_ids'])
+        return ids
+
     @api.multi
     def action_cancel(self):
         self.ensure_one()
@@ -93,15 +221,20 @@ class PrintingJob(models.Model):
 
     @api.multi
     def cancel(self, purge_job=False):
-        for job in self:
-            connection = job.server_id._open_connection()
-            if not connection:
-                continue
-
-            connection.cancelJob(job.job_id_cups, purge_job=purge_job)
-
-        # Update jobs' states info Odoo
-        self.mapped('server_id').update_jobs(
-            which='all', first_job_id=job.job_id_cups)
+        """ Cancel the jobs, with one connection per server
 
+        Only the cancelled jobs are read again from CUPS. An error lists the
+        servers which could not be reached.
+        """
+        failed_servers = self.env['printing.server']
+        for server in self.mapped('server_id'):
+            jobs = self.filtered(lambda job: job.server_id == server)
+            if not server.cancel_jobs(
+                    jobs.mapped('job_id_cups'), purge_job=purge_job):
+                failed_servers |= server
+        if failed_servers:
+            raise exceptions.UserError(
+                _("Could not cancel the jobs on the CUPS servers: %s") %
+                ', '.join('%s:%s' % (server.address, server.port)
+                          for server in failed_servers))
         return True
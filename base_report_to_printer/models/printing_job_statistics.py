@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields, api
+
+from .printing_job import FINAL_JOB_STATES
+
+
+def _job_selection(field_name):
+    def selection(self):
+        return self.env['printing.job']._fields[field_name].selection
+    return selection
+
+
+class PrintingJobStatistics(models.Model):
+    _name = 'printing.job.statistics'
+    _description = 'Printing Jobs Statistics'
+    _order = 'date DESC, printer_id'
+
+    date = fields.Date(
+        required=True, readonly=True, help='Day of creation of the jobs.')
+    printer_id = fields.Many2one(
+        comodel_name='printing.printer', string='Printer', required=True,
+        readonly=True, ondelete='cascade', help='Printer used for the jobs.')
+    server_id = fields.Many2one(
+        comodel_name='printing.server', string='Server', readonly=True,
+        ondelete='cascade', help='Server which hosts the printer.')
+    job_state = fields.Selection(
+        selection=_job_selection('job_state'), string='State', required=True,
+        readonly=True, help='Final state of the jobs.')
+    job_state_reason = fields.Selection(
+        selection=_job_selection('job_state_reason'), string='State Reason',
+        required=True, readonly=True, help='Reason of the final state.')
+    job_count = fields.Integer(
+        string='Jobs', readonly=True, help='Number of finished jobs.')
+    page_count = fields.Integer(
+        string='Pages', readonly=True, help='Number of printed pages.')
+    processed_count = fields.Integer(
+        string='Processed Jobs', readonly=True,
+        help='Number of jobs which have been processed by the printer.')
+    queue_time = fields.Float(
+        string='Total Queue Time', readonly=True,
+        help='Time, in seconds, spent by the processed jobs waiting for the '
+        'printer.')
+    processing_time = fields.Float(
+        string='Total Processing Time', readonly=True,
+        help='Time, in seconds, spent by the printer on the processed jobs.')
+    average_queue_time = fields.Float(
+        compute='_compute_average_times',
+        help='Average time, in seconds, spent by a job waiting for the '
+        'printer.')
+    average_processing_time = fields.Float(
+        compute='_compute_average_times',
+        help='Average time, in seconds, spent by the printer on a job.')
+
+    _sql_constraints = [
+        ('statistics_unique',
+         'UNIQUE(printer_id, date, job_state, job_state_reason)',
+         'Statistics must be unique per printer, day and state !'),
+    ]
+
+    @api.multi
+    @api.depends('processed_count', 'queue_time', 'processing_time')
+    def _compute_average_times(self):
+        for statistics in self.filtered('processed_count'):
+            statistics.average_queue_time = \
+                statistics.queue_time / statistics.processed_count
+            statistics.average_processing_time = \
+                statistics.processing_time / statistics.processed_count
+
+    @api.model
+    def _add_jobs(self, job_ids):
+        """ Count the jobs of `job_ids` which just reached a final state
+
+        Each job is only counted once, and the statistics are updated with
+        a single statement, so that the jobs table is never scanned.
+        """
+        if not job_ids:
+            return
+        self.env.cr.execute("""
+            WITH job AS (
+                UPDATE printing_job
+                SET statistics_done = true
+                WHERE id IN %(ids)s AND job_state IN %(final_states)s
+                    AND statistics_done IS NOT true
+                RETURNING printer_id, server_id, job_state, job_state_reason,
+                    job_impressions_completed, time_at_creation,
+                    time_at_processing, time_at_completed
+            )
+            INSERT INTO printing_job_statistics AS stats (
+                create_uid, create_date, write_uid, write_date,
+                printer_id, server_id, date, job_state, job_state_reason,
+                job_count, page_count, processed_count, queue_time,
+                processing_time)
+            SELECT
+                %(uid)s, (now() at time zone 'UTC'),
+                %(uid)s, (now() at time zone 'UTC'),
+                printer_id, server_id, time_at_creation::date, job_state,
+                COALESCE(NULLIF(job_state_reason, ''), 'none'),
+                count(*),
+                COALESCE(sum(job_impressions_completed), 0),
+                count(time_at_processing),
+                COALESCE(sum(extract(epoch FROM
+                    time_at_processing - time_at_creation)), 0),
+                COALESCE(sum(extract(epoch FROM
+                    time_at_completed - time_at_processing)), 0)
+            FROM job
+            GROUP BY printer_id, server_id, time_at_creation::date,
+                job_state, COALESCE(NULLIF(job_state_reason, ''), 'none')
+            ON CONFLICT (printer_id, date, job_state, job_state_reason)
+            DO UPDATE SET
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date,
+                job_count = stats.job_count + EXCLUDED.job_count,
+                page_count = stats.page_count + EXCLUDED.page_count,
+                processed_count =
+                    stats.processed_count + EXCLUDED.processed_count,
+                queue_time = stats.queue_time + EXCLUDED.queue_time,
+                processing_time =
+                    stats.processing_time + EXCLUDED.processing_time
+        """, {
+            'ids': tuple(job_ids),
+            'final_states': FINAL_JOB_STATES,
+            'uid': self.env.uid,
+        })
+        self.env['printing.job'].invalidate_cache(
+            ['statistics_done'], job_ids)
+        self.invalidate_cache()
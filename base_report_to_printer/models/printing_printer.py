@@ -7,16 +7,105 @@
 # Copyright (C) 2016 SYLEAM (<http://www.syleam.fr>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import base64
 import logging
 
-import os
-from tempfile import mkstemp
-
-from odoo import models, fields, api
+from odoo import models, fields, api, exceptions, _
 
+from ..cups_connection import run_parallel
+from ..tools import changed_values
+from .printing_job import FINAL_JOB_STATES
+from .printing_server import _get_jobs_attributes
 
 _logger = logging.getLogger(__name__)
 
+# Size of the chunks of documents sent to CUPS
+PRINT_CHUNK_SIZE = 65536
+# Formats of the documents sent to CUPS
+RAW_DOCUMENT_FORMAT = 'application/vnd.cups-raw'
+AUTO_DOCUMENT_FORMAT = 'application/octet-stream'
+# Statuses of the printers which cannot receive documents
+UNAVAILABLE_PRINTER_STATUSES = ('error', 'unavailable', 'server-error')
+# Attributes read from CUPS to refresh the status of a printer
+PRINTER_STATUS_ATTRIBUTES = ['printer-state', 'printer-state-message']
+
+
+def _iter_chunks(content, chunk_size=None):
+    """ Iterate over `content` by chunks of bytes
+
+    `content` may be bytes, a file object or an iterator over bytes.
+    `chunk_size` defaults to `PRINT_CHUNK_SIZE`, read at each call.
+    """
+    chunk_size = chunk_size or PRINT_CHUNK_SIZE
+    if isinstance(content, type(u'')):
+        content = content.encode('utf-8')
+    if isinstance(content, bytes):
+        for index in range(0, len(content), chunk_size):
+            yield content[index:index + chunk_size]
+    elif hasattr(content, 'read'):
+        for chunk in iter(lambda: content.read(chunk_size), b''):
+            yield chunk
+    else:
+        for chunk in content:
+            if chunk:
+                yield chunk
+
+
+def _send_document(connection, system_name, title, document_format, options,
+                   content):
+    """ Send a document to a CUPS printer, and return the id of its job
+
+    The job is canceled when the document could not be sent completely.
+    Does not depend on the environment, and may be used from other threads.
+    """
+    job_ids = []
+
+    def send(cups_connection):
+        job_ids.append(cups_connection.createJob(system_name, title, options))
+        cups_connection.startDocument(
+            system_name, job_ids[0], title, document_format, 1)
+        for chunk in _iter_chunks(content):
+            cups_connection.writeRequestData(chunk, len(chunk))
+        cups_connection.finishDocument(system_name)
+        return job_ids[0]
+
+    try:
+        return connection.run(send)
+    except Exception:
+        if job_ids:
+            job_id = job_ids[0]
+            # Do not leave an incomplete job held in the queue
+            try:
+                connection.cancelJob(job_id, purge_job=False)
+            except Exception:
+                _logger.warning(
+                    'Could not cancel the incomplete job %d of %s',
+                    job_id, system_name)
+        raise
+
+
+def _administer_printers(request):
+    """ Network part of an administration action on printers of a server
+
+    Make the `calls` over a single connection, then read the status of the
+    printers and the attributes of the jobs to refresh, as well as the ids
+    of the jobs which do not exist anymore.
+    Runs outside of the environment's thread.
+    """
+    return request['connection'].run(_administer_printers_calls, request)
+
+
+def _administer_printers_calls(connection, request):
+    for method, args, kwargs in request['calls']:
+        getattr(connection, method)(*args, **kwargs)
+    statuses = dict(
+        (name, connection.getPrinterAttributes(
+            name, requested_attributes=PRINTER_STATUS_ATTRIBUTES))
+        for name in request['printer_names'])
+    jobs_data, purged_ids = _get_jobs_attributes(
+        connection, request['job_ids'])
+    return statuses, jobs_data, purged_ids
+
 
 class PrintingPrinter(models.Model):
     """
@@ -52,25 +141,93 @@ class PrintingPrinter(models.Model):
     model = fields.Char(readonly=True)
     location = fields.Char(readonly=True)
     uri = fields.Char(string='URI', readonly=True)
+    spool = fields.Boolean(
+        string='Queue Documents',
+        help='If checked, reports sent to this printer are queued, and '
+        'sent to CUPS in the background, with retries when CUPS fails. '
+        'Users do not wait for CUPS anymore.')
+    failover_printer_id = fields.Many2one(
+        comodel_name='printing.printer', string='Failover Printer',
+        ondelete='set null',
+        help='Printer receiving the reports while this one is in error or '
+        'unavailable. Its own failover printer is used in turn.')
+
+    @api.model
+    def create(self, vals):
+        if vals.get('default'):
+            # The default printer is part of the cached report behaviours
+            self.clear_caches()
+        return super(PrintingPrinter, self).create(vals)
 
     @api.multi
-    def _prepare_update_from_cups(self, cups_connection, cups_printer):
+    def write(self, vals):
+        if 'default' in vals:
+            self.clear_caches()
+        return super(PrintingPrinter, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(PrintingPrinter, self).unlink()
+
+    @api.constrains('failover_printer_id')
+    def _check_failover_printer_id(self):
+        if not self._check_recursion(parent='failover_printer_id'):
+            raise exceptions.ValidationError(
+                _('The failover printers cannot form a loop.'))
+
+    @api.multi
+    def _get_available_printer(self):
+        """ Return the first printer of the failover chain able to print
+
+        The statuses of the last update are used, CUPS is not queried.
+        When no printer of the chain can print, the printer itself is
+        returned.
+        """
+        self.ensure_one()
+        printer = self
+        while printer:
+            if printer.status not in UNAVAILABLE_PRINTER_STATUSES:
+                return printer
+            printer = printer.failover_printer_id
+        return self
+
+    @api.model
+    def _prepare_status_from_cups(self, cups_printer):
         mapping = {
             3: 'available',
             4: 'printing',
             5: 'error'
         }
+        return {
+            'status': mapping.get(cups_printer.get(
+                'printer-state'), 'unknown'),
+            'status_message': cups_printer.get('printer-state-message', ''),
+        }
+
+    @api.multi
+    def _prepare_update_from_cups(self, cups_connection, cups_printer):
         vals = {
             'name': cups_printer['printer-info'],
             'model': cups_printer.get('printer-make-and-model', False),
             'location': cups_printer.get('printer-location', False),
             'uri': cups_printer.get('device-uri', False),
-            'status': mapping.get(cups_printer.get(
-                'printer-state'), 'unknown'),
-            'status_message': cups_printer.get('printer-state-message', ''),
         }
+        vals.update(self._prepare_status_from_cups(cups_printer))
         return vals
 
+    @api.model
+    def _cups_prefetch_calls(self, cups_printers):
+        """ Hook returning the CUPS calls `_prepare_update_from_cups` will make
+
+        `cups_printers` is the result of ``getPrinters``. The calls are
+        returned as ``(method name, positional arguments)`` pairs, and are
+        made ahead, at the same time for all servers, during the update of the
+        printers. This method is called outside of the environment's thread,
+        it must not access the database.
+        """
+        return []
+
     @api.multi
     def print_options(self, report=None, format=None, copies=1):
         """ Hook to set print options """
@@ -82,25 +239,127 @@ class PrintingPrinter(models.Model):
         return options
 
     @api.multi
-    def print_document(self, report, content, format, copies=1):
-        """ Print a file
+    def _prepare_document(self, report, format, copies=1, title=None):
+        """ Return the arguments of `_send_document` describing a document
+
+        The connection and the content of the document excepted.
+        """
+        self.ensure_one()
+        document_format = AUTO_DOCUMENT_FORMAT
+        if format == 'raw':
+            document_format = RAW_DOCUMENT_FORMAT
+        return {
+            'system_name': self.system_name,
+            'title': title or getattr(report, 'name', report) or self.name,
+            'document_format': document_format,
+            'options': self.print_options(
+                report=report, format=format, copies=copies),
+        }
+
+    @api.multi
+    def _create_job(self, job_id_cups, title, report=None, res_model=None,
+                    res_ids=None, user=None):
+        """ Record the job of a document just sent to CUPS
+
+        The job is created at once, instead of waiting for the next update
+        of the jobs, and linked to what produced it.
+        """
+        self.ensure_one()
+        if isinstance(res_ids, (int, long)):
+            res_ids = [res_ids]
+        link_values = {
+            'report_id': getattr(report, 'id', False),
+            'res_model': res_model or getattr(report, 'model', False),
+            'res_ids': res_ids and ','.join(map(str, res_ids)) or False,
+            'user_id': (user or self.env.user).id,
+        }
+        values = dict(link_values, **{
+            'name': title,
+            'active': True,
+            'job_id_cups': job_id_cups,
+            'printer_id': self.id,
+            'server_id': self.server_id.id,
+            'job_state': 'pending',
+            'job_media_progress': 0,
+            'time_at_creation': fields.Datetime.now(),
+        })
+        job_obj = self.env['printing.job'].sudo().with_context(
+            active_test=False)
+        # The job may be read from CUPS at the same time by an update of
+        # the jobs, only the links are written on an existing job
+        job_ids = job_obj._bulk_upsert([values], update_columns=link_values)
+        if not job_ids:
+            # Existing job, already linked
+            job_ids = job_obj.search([
+                ('server_id', '=', self.server_id.id),
+                ('job_id_cups', '=', job_id_cups),
+            ]).ids
+        return self.env['printing.job'].browse(job_ids)
+
+    @api.multi
+    def print_document(self, report, content, format, copies=1,
+                       title=None, res_model=None, res_ids=None, wait=None):
+        """ Print a document
 
+        `content` may be bytes, a file object or an iterator over bytes.
+        It is sent to CUPS by chunks, without being written to disk.
         Format could be pdf, qweb-pdf, raw, ...
+        Return the created job, linked to the printed records, given by
+        `res_model` and `res_ids`, or by the model of the report.
+        When `wait` is given, the job is returned once it is finished, or
+        after `wait` seconds, with its last state.
 
         """
         self.ensure_one()
-        fd, file_name = mkstemp()
-        try:
-            os.write(fd, content)
-        finally:
-            os.close(fd)
+        connection = self.server_id._open_connection(raise_on_error=True)
+        document = self._prepare_document(
+            report, format, copies=copies, title=title)
 
-        return self.print_file(
-            file_name, report=report, copies=copies, format=format)
+        _logger.debug(
+            'Sending job to CUPS printer %s on %s'
+            % (self.system_name, self.server_id.address))
+        job_id = _send_document(connection, content=content, **document)
+        _logger.info("Printing job: '%s' on %s" % (
+            document['title'],
+            self.server_id.address,
+        ))
+        job = self._create_job(
+            job_id, document['title'], report=report, res_model=res_model,
+            res_ids=res_ids)
+        if wait:
+            self.server_id.wait_for_job(job_id, wait)
+        return job
+
+    @api.multi
+    def print_attachment(self, attachment, copies=1, format=None,
+                         wait=None):
+        """ Print an attachment
+
+        Attachments of the filestore are read by chunks from their file, the
+        others are decoded from the database.
+        """
+        self.ensure_one()
+        attachment.ensure_one()
+        if attachment.type != 'binary':
+            raise exceptions.UserError(
+                _('Only attachments holding a file can be printed.'))
+        kwargs = {
+            'copies': copies,
+            'title': attachment.name,
+            'res_model': attachment._name,
+            'res_ids': attachment.ids,
+            'wait': wait,
+        }
+        if not attachment.store_fname:
+            return self.print_document(
+                None, base64.b64decode(attachment.datas or ''), format,
+                **kwargs)
+        with open(attachment._full_path(attachment.store_fname), 'rb') as fd:
+            return self.print_document(None, fd, format, **kwargs)
 
     @api.multi
     def print_file(self, file_name, report=None, copies=1, format=None):
-        """ Print a file """
+        """ Print a file, and return the created job """
         self.ensure_one()
 
         connection = self.server_id._open_connection(raise_on_error=True)
@@ -110,15 +369,15 @@ class PrintingPrinter(models.Model):
         _logger.debug(
             'Sending job to CUPS printer %s on %s'
             % (self.system_name, self.server_id.address))
-        connection.printFile(self.system_name,
-                             file_name,
-                             file_name,
-                             options=options)
+        job_id = connection.printFile(self.system_name,
+                                      file_name,
+                                      file_name,
+                                      options=options)
         _logger.info("Printing job: '%s' on %s" % (
             file_name,
             self.server_id.address,
         ))
-        return True
+        return self._create_job(job_id, file_name, report=report)
 
     @api.multi
     def set_default(self):
@@ -141,34 +400,73 @@ class PrintingPrinter(models.Model):
 
     @api.multi
     def cancel_all_jobs(self, purge_jobs=False):
-        for printer in self:
-            connection = printer.server_id._open_connection()
-            connection.cancelAllJobs(
-                name=printer.system_name, purge_jobs=purge_jobs)
-
-        # Update jobs' states into Odoo
-        self.mapped('server_id').update_jobs(which='completed')
-
-        return True
+        return self._administer(
+            lambda printer: ('cancelAllJobs', (), {
+                'name': printer.system_name,
+                'purge_jobs': purge_jobs,
+            }), refresh_jobs=True)
 
     @api.multi
     def enable(self):
-        for printer in self:
-            connection = printer.server_id._open_connection()
-            connection.enablePrinter(printer.system_name)
-
-        # Update printers' stats into Odoo
-        self.mapped('server_id').update_printers()
-
-        return True
+        return self._administer(
+            lambda printer: ('enablePrinter', (printer.system_name, ), {}))
 
     @api.multi
     def disable(self):
-        for printer in self:
-            connection = printer.server_id._open_connection()
-            connection.disablePrinter(printer.system_name)
+        return self._administer(
+            lambda printer: ('disablePrinter', (printer.system_name, ), {}))
+
+    @api.multi
+    def _administer(self, prepare_call, refresh_jobs=False):
+        """ Run an administration action on the printers
+
+        `prepare_call` returns the ``(method name, positional arguments,
+        keyword arguments)`` of the CUPS call to make for a printer. The
+        calls are made over one connection per server, all servers at the
+        same time. Then only the status of these printers is updated, and
+        with `refresh_jobs`, their unfinished jobs. Jobs which do not exist
+        anymore are archived as cancelled.
+        """
+        job_obj = self.env['printing.job']
+        servers = self.mapped('server_id')
+        requests = []
+        open_jobs = []
+        for server in servers:
+            printers = self.filtered(lambda record: record.server_id == server)
+            jobs = job_obj
+            if refresh_jobs:
+                jobs = job_obj.search([
+                    ('printer_id', 'in', printers.ids),
+                    ('job_state', 'not in', FINAL_JOB_STATES),
+                ])
+            open_jobs.append(jobs)
+            requests.append({
+                'connection': server._get_connection(),
+                'calls': [prepare_call(printer) for printer in printers],
+                'printer_names': printers.mapped('system_name'),
+                'job_ids': jobs.mapped('job_id_cups'),
+            })
+        results = run_parallel(_administer_printers, requests)
 
-        # Update printers' stats into Odoo
-        self.mapped('server_id').update_printers()
+        errors = []
+        for server, jobs, (result, error) in zip(
+                servers, open_jobs, results):
+            if error is not None:
+                errors.append(server._connection_error_message(error))
+                continue
+            statuses, jobs_data, purged_ids = result
+            for printer in self.filtered(
+                    lambda record: record.server_id == server):
+                printer_values = changed_values(
+                    printer, printer._prepare_status_from_cups(
+                        statuses[printer.system_name]))
+                if printer_values:
+                    printer.write(printer_values)
+            server._update_jobs_from_cups(jobs_data)
+            jobs.filtered(
+                lambda job: job.job_id_cups in purged_ids,
+            ).write({'job_state': 'canceled', 'active': False})
 
+        if errors:
+            raise exceptions.UserError('\n'.join(errors))
         return True
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, fields, api
+
+from .printing_job import FINAL_JOB_STATES
+from .printing_printer import UNAVAILABLE_PRINTER_STATUSES
+
+
+class PrintingPrinterPool(models.Model):
+    _name = 'printing.printer.pool'
+    _description = 'Printer Pool'
+    _order = 'name'
+
+    name = fields.Char(required=True, help='Name of the pool.')
+    active = fields.Boolean(default=True)
+    printer_ids = fields.Many2many(
+        comodel_name='printing.printer', string='Printers',
+        help='Printers sharing the documents sent to the pool.')
+
+    @api.multi
+    def write(self, vals):
+        if 'active' in vals:
+            # Archived pools are not part of the report behaviours anymore
+            self.clear_caches()
+        return super(PrintingPrinterPool, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        # The pools are part of the cached report behaviours
+        self.clear_caches()
+        return super(PrintingPrinterPool, self).unlink()
+
+    @api.multi
+    def select_printer(self):
+        """ Return the available printer of the pool with the fewest jobs
+
+        Pending jobs are counted from the jobs known by Odoo and from the
+        documents still waiting in the print spool, and the status of the
+        printers is the one of their last update, so that CUPS is not
+        queried. When no printer is available, the first one is returned.
+        """
+        self.ensure_one()
+        printers = self.printer_ids.filtered(
+            lambda printer: printer.status not in
+            UNAVAILABLE_PRINTER_STATUSES) or self.printer_ids[:1]
+        if len(printers) < 2:
+            return printers
+
+        groups = self.env['printing.job'].sudo().read_group([
+            ('printer_id', 'in', printers.ids),
+            ('job_state', 'not in', FINAL_JOB_STATES),
+        ], ['printer_id'], ['printer_id'])
+        groups += self.env['printing.spool'].sudo().read_group([
+            ('printer_id', 'in', printers.ids),
+            ('state', '=', 'pending'),
+        ], ['printer_id'], ['printer_id'])
+        job_counts = {}
+        for group in groups:
+            printer_id = group['printer_id'][0]
+            job_counts[printer_id] = \
+                job_counts.get(printer_id, 0) + group['printer_id_count']
+        # On equal counts, printers are taken by name, the order of the model
+        return min(
+            printers, key=lambda printer: job_counts.get(printer.id, 0))
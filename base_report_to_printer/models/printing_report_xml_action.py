@@ -27,6 +27,23 @@ class PrintingReportXmlAction(models.Model):
     )
     printer_id = fields.Many2one(comodel_name='printing.printer',
                                  string='Printer')
+    printer_pool_id = fields.Many2one(comodel_name='printing.printer.pool',
+                                      string='Printer Pool')
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super(PrintingReportXmlAction, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super(PrintingReportXmlAction, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super(PrintingReportXmlAction, self).unlink()
 
     @api.multi
     def behaviour(self):
@@ -35,4 +52,5 @@ class PrintingReportXmlAction(models.Model):
         return {
             'action': self.action,
             'printer': self.printer_id,
+            'printer_pool': self.printer_pool_id,
         }
@@ -3,9 +3,23 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import logging
-from datetime import datetime
+import time
+from datetime import timedelta
+from functools import partial
 from odoo import models, fields, api, exceptions, _
 
+from ..cups_connection import (
+    PooledConnection,
+    PrefetchedConnection,
+    ServerUnavailable,
+    get_pool,
+    prefetch,
+    run_parallel,
+    stream_parallel,
+)
+from ..tools import changed_values, commit
+from .printing_job import FINAL_JOB_STATES
+
 _logger = logging.getLogger(__name__)
 
 
@@ -15,6 +29,268 @@ except ImportError:
     _logger.debug('Cannot `import cups`.')
 
 
+JOB_ATTRIBUTES = [
+    'job-name',
+    'job-id',
+    'printer-uri',
+    'job-media-progress',
+    'time-at-creation',
+    'job-state',
+    'job-state-reasons',
+    'time-at-processing',
+    'time-at-completed',
+    'job-impressions-completed',
+]
+
+
+# Events notified to the subscription of a server
+SUBSCRIPTION_EVENTS = [
+    'printer-added',
+    'printer-deleted',
+    'printer-modified',
+    'printer-state-changed',
+    'job-created',
+    'job-state-changed',
+    'job-completed',
+]
+# Events requiring to refresh the list of printers
+PRINTER_LIST_EVENTS = ('printer-added', 'printer-deleted', 'printer-modified')
+# Lifetime of the subscriptions, in seconds, renewed when half of it elapsed
+SUBSCRIPTION_LEASE = 86400
+# Number of jobs deleted by each transaction of the retention policy
+PURGE_CHUNK_SIZE = 1000
+# Maximum number of jobs read from CUPS at once
+JOBS_PAGE_SIZE = 500
+# CUPS states of the jobs which will not change anymore
+FINAL_CUPS_JOB_STATES = (7, 8, 9)
+# Seconds between the first two reads of a job waited for, doubled each time
+JOB_WAIT_BACKOFF = 0.1
+# Maximum number of seconds between two reads of a job waited for
+JOB_WAIT_MAX_BACKOFF = 2
+
+
+def _cups_connection(address, port):
+    return cups.Connection(host=address, port=port)
+
+
+def _fetch_printers(prefetch_calls, connection):
+    """ Network part of the printers update of a server
+
+    Runs outside of the environment's thread.
+    """
+    try:
+        connection.check()
+    except Exception as error:
+        return {'connection_error': error}
+    printers = connection.getPrinters()
+    return {
+        'printers': printers,
+        'prefetched': prefetch(connection, prefetch_calls(printers)),
+    }
+
+
+def _get_jobs(connection, which_jobs='all', first_job_id=-1,
+              requested_attributes=None):
+    """ Get the jobs of a server by pages of at most `JOBS_PAGE_SIZE` jobs
+
+    Only the list of all jobs is sorted by id, which allows to read it by
+    pages. Other lists, which only hold jobs not completed yet, or jobs
+    sorted by completion time, are read at once.
+    """
+    if which_jobs != 'all':
+        jobs = connection.getJobs(
+            which_jobs=which_jobs, first_job_id=first_job_id,
+            requested_attributes=requested_attributes)
+        if jobs:
+            yield jobs
+        return
+    while True:
+        page = connection.getJobs(
+            which_jobs=which_jobs, first_job_id=first_job_id,
+            limit=JOBS_PAGE_SIZE, requested_attributes=requested_attributes)
+        if page:
+            yield page
+        if len(page) < JOBS_PAGE_SIZE:
+            return
+        first_job_id = max(page) + 1
+
+
+def _get_job_attributes(connection, job_id):
+    """ Return the attributes of a single job, as given by ``getJobs`` """
+    job_data = connection.getJobAttributes(
+        job_id, requested_attributes=JOB_ATTRIBUTES + ['job-printer-uri'])
+    job_data.setdefault('printer-uri', job_data.get('job-printer-uri', ''))
+    return job_data
+
+
+def _get_jobs_attributes(connection, job_ids):
+    """ Read jobs one by one
+
+    Return the attributes of the jobs read, and the ids of the jobs CUPS
+    does not know anymore. Jobs which could not be read for another reason
+    are in neither.
+    """
+    jobs_data = {}
+    purged_ids = []
+    for job_id in job_ids:
+        try:
+            jobs_data[job_id] = _get_job_attributes(connection, job_id)
+        except cups.IPPError as error:
+            if error.args[0] == cups.IPP_NOT_FOUND:
+                purged_ids.append(job_id)
+            else:
+                _logger.warning('Could not read job %d: %s', job_id, error)
+    return jobs_data, purged_ids
+
+
+def _wait_for_job(connection, job_id, timeout):
+    """ Read a job until it is finished, or for at most `timeout` seconds
+
+    Return the last attributes read. The delay between two reads grows
+    from `JOB_WAIT_BACKOFF` to `JOB_WAIT_MAX_BACKOFF`.
+    """
+    deadline = time.time() + timeout
+    backoff = JOB_WAIT_BACKOFF
+    while True:
+        job_data = _get_job_attributes(connection, job_id)
+        remaining = deadline - time.time()
+        if job_data.get('job-state') in FINAL_CUPS_JOB_STATES or \
+                remaining <= 0:
+            return job_data
+        time.sleep(min(backoff, remaining))
+        backoff = min(backoff * 2, JOB_WAIT_MAX_BACKOFF)
+
+
+def _cancel_jobs(connection, job_ids, purge_job=False):
+    """ Cancel jobs over a single connection
+
+    Return the ids of the cancelled jobs, and the attributes of the ones
+    which are not purged. The jobs which cannot be cancelled are skipped.
+    """
+    def cancel(session):
+        cancelled_ids = []
+        for job_id in job_ids:
+            try:
+                session.cancelJob(job_id, purge_job=purge_job)
+            except Exception as error:
+                # Already finished or unknown job
+                _logger.warning('Could not cancel job %d: %s', job_id, error)
+                continue
+            cancelled_ids.append(job_id)
+        jobs_data = {}
+        if not purge_job:
+            jobs_data = _get_jobs_attributes(session, cancelled_ids)[0]
+        return cancelled_ids, jobs_data
+
+    return connection.run(cancel)
+
+
+def _fetch_jobs(connection_requests):
+    """ Network part of the jobs update of a server
+
+    Generate the jobs by pages, the next page being only read when the
+    previous one was consumed.
+    Runs outside of the environment's thread.
+    """
+    connection, requests = connection_requests
+    for request in requests:
+        for page in _get_jobs(connection, **request):
+            yield page
+
+
+def _fetch_new_jobs(request):
+    """ Network part of the incremental jobs update of a server
+
+    Generate by pages the jobs created after the last synchronized one, the
+    jobs not completed yet, then the final state of the jobs known as open
+    which are in none of both lists.
+    Runs outside of the environment's thread.
+    """
+    connection = request['connection']
+    open_job_ids = set(request['open_job_ids'])
+    for page in _get_jobs(
+            connection, which_jobs='all',
+            first_job_id=request['last_job_id'] + 1,
+            requested_attributes=JOB_ATTRIBUTES):
+        open_job_ids.difference_update(page)
+        yield page
+    for page in _get_jobs(
+            connection, which_jobs='not-completed',
+            requested_attributes=JOB_ATTRIBUTES):
+        open_job_ids.difference_update(page)
+        yield page
+
+    jobs_data = {}
+    for job_id in open_job_ids:
+        try:
+            jobs_data[job_id] = _get_job_attributes(connection, job_id)
+        except Exception:
+            # The job has already been purged
+            continue
+    if jobs_data:
+        yield jobs_data
+
+
+def _fetch_notifications(subscription):
+    """ Network part of the notifications-based update of a server
+
+    Return the events notified since the last known sequence number, with the
+    attributes of the jobs they mention. When the server does not know the
+    subscription, a new one is created and the events are None. Other errors
+    are raised, to try again at the next update.
+    Runs outside of the environment's thread.
+    """
+    connection = subscription['connection']
+    subscription_id = subscription['subscription_id']
+    if subscription_id:
+        try:
+            notifications = connection.getNotifications(
+                [subscription_id],
+                sequence_numbers=[subscription['sequence'] + 1])
+        except cups.IPPError as error:
+            # Other errors are transient, the subscription is still valid
+            if error.args[0] != cups.IPP_NOT_FOUND:
+                raise
+            # Expired subscription, or lost by the server
+            _logger.info(
+                'CUPS subscription %d on %s is not available anymore',
+                subscription_id, subscription['uri'])
+        else:
+            renewed = False
+            if subscription['renew']:
+                connection.renewSubscription(
+                    subscription_id, lease_duration=SUBSCRIPTION_LEASE)
+                renewed = True
+            events = sorted(
+                notifications.get('events', []),
+                key=lambda event: event['notify-sequence-number'])
+            jobs_data = {}
+            for job_id in set(event['notify-job-id'] for event in events
+                              if event.get('notify-job-id')):
+                try:
+                    jobs_data[job_id] = _get_job_attributes(
+                        connection, job_id)
+                except Exception:
+                    # The job has already been purged
+                    continue
+            return {
+                'subscription_id': subscription_id,
+                'renewed': renewed,
+                'events': events,
+                'jobs': jobs_data,
+            }
+
+    subscription_id = connection.createSubscription(
+        subscription['uri'], events=SUBSCRIPTION_EVENTS,
+        lease_duration=SUBSCRIPTION_LEASE)
+    return {
+        'subscription_id': subscription_id,
+        'renewed': True,
+        'events': None,
+        'jobs': {},
+    }
+
+
 class PrintingServer(models.Model):
     _name = 'printing.server'
     _description = 'Printing server'
@@ -28,34 +304,176 @@ class PrintingServer(models.Model):
         default=631, required=True, help='Port of the server.')
     active = fields.Boolean(
         default=True, help='If checked, this server is useable.')
+    connect_timeout = fields.Float(
+        default=5, help='Maximum time, in seconds, allowed to open a '
+        'connection to the server. Zero means no limit.')
+    call_timeout = fields.Float(
+        string='Call Timeout', default=60,
+        help='Maximum time, in seconds, allowed for a single request to the '
+        'server. Operations made of many requests, like sending a document '
+        'by chunks, may take longer. Zero means no limit.')
     printer_ids = fields.One2many(
         comodel_name='printing.printer', inverse_name='server_id',
         string='Printers List',
         help='List of printers available on this server.')
+    sync_mode = fields.Selection(
+        selection=[
+            ('poll', 'Polling'),
+            ('subscription', 'Notifications'),
+        ],
+        string='Synchronization', required=True, default='poll',
+        help='Polling: the whole list of printers and jobs is read from CUPS '
+        'at each update.\n'
+        'Notifications: CUPS notifies the changes on printers and jobs, and '
+        'only these changes are read at each update.')
+    printer_update_interval = fields.Integer(
+        string='Printers Update', default=60,
+        help='Interval, in minutes, between two updates of the list and the '
+        'settings of the printers.')
+    printer_update_date = fields.Datetime(
+        string='Last Printers Update', readonly=True, copy=False,
+        help='Date of the last update of the list and settings of printers.')
+    status_update_interval = fields.Integer(
+        string='Printers Status Update', default=1,
+        help='Interval, in minutes, between two updates of the status of '
+        'the printers.')
+    status_update_date = fields.Datetime(
+        string='Last Printers Status Update', readonly=True, copy=False,
+        help='Date of the last update of the status of the printers.')
+    job_update_interval = fields.Integer(
+        string='Open Jobs Update', default=1,
+        help='Interval, in minutes, between two updates of the new and open '
+        'jobs.')
+    job_update_date = fields.Datetime(
+        string='Last Open Jobs Update', readonly=True, copy=False,
+        help='Date of the last update of the new and open jobs.')
+    last_job_id_cups = fields.Integer(
+        string='Last Synchronized Job', readonly=True, copy=False,
+        help='Highest CUPS id of the jobs synchronized from this server.')
+    job_full_sync_interval = fields.Integer(
+        string='Full Jobs Synchronization', default=24,
+        help='Interval, in hours, between two reads of the whole list of '
+        'jobs kept by CUPS. In-between, only the new and the open jobs are '
+        'read. Zero means that the whole list is read at each update.')
+    job_full_sync_date = fields.Datetime(
+        string='Last Full Jobs Synchronization', readonly=True, copy=False,
+        help='Date of the last read of the whole list of jobs.')
+    job_retention_days = fields.Integer(
+        string='Keep Jobs (Days)',
+        help='Finished and purged jobs older than this number of days are '
+        'deleted. Zero means no limit.')
+    job_retention_count = fields.Integer(
+        string='Keep Jobs (Per Printer)',
+        help='Finished and purged jobs are deleted beyond this number of '
+        'jobs per printer. Zero means no limit.')
+    purged_job_id_cups = fields.Integer(
+        string='Last Deleted Job', readonly=True, copy=False,
+        help='Highest CUPS id of the jobs deleted by the retention policy. '
+        'Finished jobs up to this id are not synchronized again.')
+    subscription_id = fields.Integer(
+        readonly=True, copy=False,
+        help='Id of the CUPS notifications subscription of this server.')
+    subscription_sequence = fields.Integer(
+        readonly=True, copy=False,
+        help='Sequence number of the last processed notification.')
+    subscription_date = fields.Datetime(
+        readonly=True, copy=False,
+        help='Date of the last creation or renewal of the subscription.')
+
+    @api.multi
+    def _get_connection(self):
+        """ Return a connection to the CUPS server, without contacting it
+
+        The returned object behaves like a ``cups.Connection``, but borrows a
+        warm connection from the worker's pool for each call, and bounds each
+        call by the timeouts of the server. It does not depend on the
+        environment, and may be used from other threads.
+        """
+        self.ensure_one()
+        return PooledConnection(
+            get_pool(self.address, self.port),
+            partial(_cups_connection, self.address, self.port),
+            connect_timeout=self.connect_timeout,
+            call_timeout=self.call_timeout)
+
+    @api.multi
+    def _connection_error_message(self, error):
+        self.ensure_one()
+        if isinstance(error, ServerUnavailable):
+            return _("The CUPS server on %s:%s failed to answer %d times "
+                     "in a row. It will not be contacted again during the "
+                     "next %d seconds.") % (
+                         self.address, self.port, error.failures,
+                         error.retry_in)
+        return _("Failed to connect to the CUPS server on %s:%s. "
+                 "Check that the CUPS server is running and that "
+                 "you can reach it from the Odoo server.") % (
+                     self.address, self.port)
 
     @api.multi
     def _open_connection(self, raise_on_error=False):
+        """ Return a connection to the CUPS server, as `_get_connection`
+
+        When the server failed to answer several times in a row, it is not
+        contacted again before a backoff delay, and this method fails at once.
+        """
         self.ensure_one()
-        connection = False
         try:
-            connection = cups.Connection(host=self.address, port=self.port)
-        except:
-            message = _("Failed to connect to the CUPS server on %s:%s. "
-                        "Check that the CUPS server is running and that "
-                        "you can reach it from the Odoo server.") % (
-                            self.address, self.port)
+            connection = self._get_connection()
+            connection.check()
+        except Exception as error:
+            connection = False
+            message = self._connection_error_message(error)
             _logger.warning(message)
             if raise_on_error:
                 raise exceptions.UserError(message)
 
         return connection
 
+    @api.multi
+    def write(self, vals):
+        # Subscriptions are bound to a CUPS server and a synchronization mode
+        subscription_fields = {'address', 'port', 'sync_mode'} & set(vals)
+        self.filtered(lambda server: any(
+            server[field] != vals[field] for field in subscription_fields
+        ))._cancel_subscription()
+        return super(PrintingServer, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._cancel_subscription()
+        return super(PrintingServer, self).unlink()
+
+    @api.multi
+    def _cancel_subscription(self):
+        """ Cancel the CUPS notifications subscriptions, if any """
+        for server in self.filtered('subscription_id'):
+            try:
+                server._get_connection().cancelSubscription(
+                    server.subscription_id)
+            except Exception:
+                _logger.info(
+                    'Could not cancel the CUPS subscription %d on %s:%s',
+                    server.subscription_id, server.address, server.port)
+            super(PrintingServer, server).write({
+                'subscription_id': 0,
+                'subscription_sequence': 0,
+                'subscription_date': False,
+            })
+
     @api.multi
     def action_update_printers(self):
         return self.update_printers()
 
     @api.multi
-    def update_printers(self, domain=None, raise_on_error=False):
+    def update_printers(self, domain=None, raise_on_error=False,
+                        status_only=False):
+        """ Update the printers from CUPS
+
+        With `status_only`, only the status of the known printers is updated,
+        which saves the requests made to read their settings. The printers
+        of servers which have new printers are fully updated anyway.
+        """
         if domain is None:
             domain = []
 
@@ -63,161 +481,571 @@ class PrintingServer(models.Model):
         if not self:
             servers = self.search(domain)
 
+        # Retrieve the printers of all servers at the same time
+        printer_obj = self.env['printing.printer']
+        connections = [server._get_connection() for server in servers]
+        prefetch_calls = printer_obj._cups_prefetch_calls
+        if status_only:
+            prefetch_calls = lambda cups_printers: []  # noqa: E731
+        results = run_parallel(
+            partial(_fetch_printers, prefetch_calls), connections)
+
         res = True
-        for server in servers:
-            connection = server._open_connection(raise_on_error=raise_on_error)
-            if not connection:
-                server.printer_ids.write({'status': 'server-error'})
+        new_printers_servers = self.browse()
+        for server, connection, (result, error) in zip(
+                servers, connections, results):
+            if error is None and 'connection_error' in result:
+                error = result['connection_error']
+                message = server._connection_error_message(error)
+            elif error is not None:
+                message = _("Could not get the list of printers from the "
+                            "CUPS server (%s:%s)") % (
+                                server.address, server.port)
+            if error is not None:
+                _logger.warning(message)
+                if raise_on_error:
+                    raise exceptions.UserError(message)
+                server.printer_ids.filtered(
+                    lambda record: record.status != 'server-error')\
+                    .write({'status': 'server-error'})
                 res = False
                 continue
 
             # Update Printers
-            printers = connection.getPrinters()
+            connection = PrefetchedConnection(
+                connection, result['prefetched'])
             existing_printers = dict([
                 (printer.system_name, printer)
                 for printer in server.printer_ids
             ])
-            updated_printers = []
-            for name, printer_info in printers.iteritems():
-                printer = self.env['printing.printer']
+            if status_only and set(result['printers']) - set(
+                    existing_printers):
+                new_printers_servers |= server
+                continue
+            updated_printers = set()
+            new_printers_values = []
+            for name, printer_info in result['printers'].iteritems():
+                printer = printer_obj
                 if name in existing_printers:
                     printer = existing_printers[name]
 
-                printer_values = printer._prepare_update_from_cups(
-                    connection, printer_info)
-                printer_values.update(
-                    system_name=name,
-                    server_id=server.id,
-                )
-                updated_printers.append(name)
-                if not printer:
-                    printer.create(printer_values)
+                updated_printers.add(name)
+                if status_only:
+                    printer_values = printer._prepare_status_from_cups(
+                        printer_info)
                 else:
+                    printer_values = printer._prepare_update_from_cups(
+                        connection, printer_info)
+                    printer_values.update(
+                        system_name=name,
+                        server_id=server.id,
+                    )
+                if not printer:
+                    new_printers_values.append(printer_values)
+                    continue
+
+                # Only write what changed since the last update
+                printer_values = changed_values(printer, printer_values)
+                if printer_values:
                     printer.write(printer_values)
 
+            for printer_values in new_printers_values:
+                printer_obj.create(printer_values)
+
             # Set printers not found as unavailable
             server.printer_ids.filtered(
-                lambda record: record.system_name not in updated_printers)\
+                lambda record: record.system_name not in updated_printers and
+                record.status != 'unavailable')\
                 .write({'status': 'unavailable'})
 
+        if new_printers_servers:
+            res = new_printers_servers.update_printers(
+                raise_on_error=raise_on_error) and res
+
         return res
 
     def action_update_jobs(self):
+        scheduled = not self
         if not self:
             self = self.search([])
-        return self.update_jobs()
+        subscribed_servers = self.filtered(
+            lambda server: server.sync_mode == 'subscription')
+        if subscribed_servers:
+            subscribed_servers.update_from_notifications()
+        if self - subscribed_servers:
+            # Updates requested by a user are made at once
+            (self - subscribed_servers).update_due(force=not scheduled)
+        return True
 
     @api.multi
-    def update_jobs(self, which='all', first_job_id=-1):
-        job_obj = self.env['printing.job']
-        printer_obj = self.env['printing.printer']
+    def update_due(self, force=False):
+        """ Run the updates of printers and jobs whose interval elapsed
 
-        mapping = {
-            3: 'pending',
-            4: 'pending held',
-            5: 'processing',
-            6: 'processing stopped',
-            7: 'canceled',
-            8: 'aborted',
-            9: 'completed',
-        }
+        Each kind of update has its own interval, from the costly update of
+        the printers settings to the cheap update of the open jobs. With
+        `force`, all updates are made.
+        """
+        now = fields.Datetime.from_string(fields.Datetime.now())
 
-        # Update printers list, to ensure that jobs printers will be in Odoo
-        self.update_printers()
+        def due(interval_field, date_field, unit='minutes'):
+            return self.filtered(
+                lambda server: force or not server[date_field] or
+                fields.Datetime.from_string(server[date_field]) +
+                timedelta(**{unit: server[interval_field]}) <= now)
 
+        printers_servers = due('printer_update_interval',
+                               'printer_update_date')
+        status_servers = due('status_update_interval',
+                             'status_update_date') - printers_servers
+        full_jobs_servers = due('job_full_sync_interval',
+                                'job_full_sync_date', unit='hours')
+        jobs_servers = due('job_update_interval',
+                           'job_update_date') - full_jobs_servers
+
+        now = fields.Datetime.to_string(now)
+        if printers_servers:
+            printers_servers.write({
+                'printer_update_date': now,
+                'status_update_date': now,
+            })
+            printers_servers.update_printers()
+        if status_servers:
+            status_servers.write({'status_update_date': now})
+            status_servers.update_printers(status_only=True)
+        if full_jobs_servers:
+            full_jobs_servers.write({'job_update_date': now})
+            full_jobs_servers.update_jobs()
+        if jobs_servers:
+            jobs_servers.write({'job_update_date': now})
+            jobs_servers.update_jobs_incremental()
+        return True
+
+    @api.multi
+    def update_jobs_incremental(self):
+        """ Update the new jobs and the jobs not completed yet """
+        if not self:
+            return True
+
+        # Jobs known as open are the ones whose final state is still missing
+        self.env.cr.execute("""
+            SELECT server_id, array_agg(job_id_cups)
+            FROM printing_job
+            WHERE server_id IN %s AND active
+                AND job_state NOT IN %s
+            GROUP BY server_id
+        """, (tuple(self.ids), FINAL_JOB_STATES))
+        open_job_ids = dict(self.env.cr.fetchall())
+
+        pages = stream_parallel(_fetch_new_jobs, [{
+            'connection': server._get_connection(),
+            'last_job_id': server.last_job_id_cups,
+            'open_job_ids': open_job_ids.get(server.id, []),
+        } for server in self])
+
+        for index, jobs_data, error in pages:
+            server = self[index]
+            if error is not None:
+                _logger.warning(
+                    'Could not get the jobs from the CUPS server (%s:%s): %s',
+                    server.address, server.port, error)
+                continue
+            if not jobs_data:
+                continue
+            server._update_jobs_from_cups(jobs_data)
+            if max(jobs_data) > server.last_job_id_cups:
+                server.last_job_id_cups = max(jobs_data)
+
+        return True
+
+    @api.multi
+    def update_from_notifications(self):
+        """ Update printers and jobs from the changes notified by CUPS
+
+        Only the events notified since the last update are read, and the jobs
+        they mention are fetched one by one. A full update is made when the
+        subscription is created, or when events have been lost.
+        """
+        now = fields.Datetime.from_string(fields.Datetime.now())
+        subscriptions = []
         for server in self:
-            connection = server._open_connection()
-            if not connection:
+            renew_date = server.subscription_date and \
+                fields.Datetime.from_string(server.subscription_date) + \
+                timedelta(seconds=SUBSCRIPTION_LEASE / 2)
+            subscriptions.append({
+                'connection': server._get_connection(),
+                'uri': 'ipp://%s:%d/' % (server.address, server.port),
+                'subscription_id': server.subscription_id,
+                'sequence': server.subscription_sequence,
+                'renew': not renew_date or renew_date <= now,
+            })
+        results = run_parallel(_fetch_notifications, subscriptions)
+
+        full_update_servers = self.browse()
+        for server, (result, error) in zip(self, results):
+            if error is not None:
+                _logger.warning(
+                    'Could not get the notifications from the CUPS server '
+                    '(%s:%s): %s', server.address, server.port, error)
                 continue
 
-            # Retrieve asked job data
-            jobs_data = connection.getJobs(
-                which_jobs=which, first_job_id=first_job_id,
-                requested_attributes=[
-                    'job-name',
-                    'job-id',
-                    'printer-uri',
-                    'job-media-progress',
-                    'time-at-creation',
-                    'job-state',
-                    'job-state-reasons',
-                    'time-at-processing',
-                    'time-at-completed',
-                ])
+            values = {'subscription_id': result['subscription_id']}
+            if result['renewed']:
+                values['subscription_date'] = fields.Datetime.to_string(now)
+            events = result['events']
+            if events is None:
+                # New subscription, everything has to be read once
+                values['subscription_sequence'] = 0
+                full_update_servers |= server
+            elif events:
+                values['subscription_sequence'] = \
+                    events[-1]['notify-sequence-number']
+                if events[0]['notify-sequence-number'] > \
+                        server.subscription_sequence + 1:
+                    # CUPS only keeps a limited number of events
+                    full_update_servers |= server
+                else:
+                    server._update_from_events(events, result['jobs'])
+            server.write(values)
+
+        if full_update_servers:
+            full_update_servers.update_printers()
+            full_update_servers.update_jobs()
+
+        return True
+
+    @api.multi
+    def _update_from_events(self, events, jobs_data):
+        """ Apply CUPS notification events on printers and jobs
+
+        `jobs_data` contains the attributes of the jobs mentioned by the
+        events, as returned by ``getJobAttributes``.
+        """
+        self.ensure_one()
+        printer_obj = self.env['printing.printer']
+        printers = dict(
+            (printer.system_name, printer) for printer in self.printer_ids)
+        unknown_printers = set(
+            event['printer-name'] for event in events
+            if event.get('printer-name') and
+            event['printer-name'] not in printers)
+        if unknown_printers or any(
+                event['notify-subscribed-event'] in PRINTER_LIST_EVENTS
+                for event in events):
+            self.update_printers()
+        else:
+            # Only the last state of each printer matters
+            printer_events = dict(
+                (event['printer-name'], event) for event in events
+                if event['notify-subscribed-event'] == 'printer-state-changed')
+            for name, event in printer_events.items():
+                printer_values = changed_values(
+                    printers[name],
+                    printer_obj._prepare_status_from_cups(event))
+                if printer_values:
+                    printers[name].write(printer_values)
+
+        if jobs_data:
+            self._update_jobs_from_cups(jobs_data)
+
+    @api.multi
+    def update_jobs(self, which='all', first_job_id=-1):
+        job_obj = self.env['printing.job']
+
+        # Prepare the requests to send to each server
+        connections = []
+        for server in self:
+            requests = [{
+                'which_jobs': which,
+                'first_job_id': first_job_id,
+                'requested_attributes': JOB_ATTRIBUTES,
+            }]
 
             # Retrieve known uncompleted jobs data to update them
             if which == 'not-completed':
                 oldest_uncompleted_job = job_obj.search([
-                    ('job_state', 'not in', (
-                        'canceled',
-                        'aborted',
-                        'completed',
-                    )),
+                    ('server_id', '=', server.id),
+                    ('job_state', 'not in', FINAL_JOB_STATES),
                 ], limit=1, order='job_id_cups')
                 if oldest_uncompleted_job:
-                    jobs_data.update(connection.getJobs(
-                        which_jobs='completed',
-                        first_job_id=oldest_uncompleted_job.job_id_cups,
-                        requested_attributes=[
-                            'job-name',
-                            'job-id',
-                            'printer-uri',
-                            'job-media-progress',
-                            'time-at-creation',
-                            'job-state',
-                            'job-state-reasons',
-                            'time-at-processing',
-                            'time-at-completed',
-                        ]))
-
-            all_cups_job_ids = set()
-            for cups_job_id, job_data in jobs_data.items():
-                all_cups_job_ids.add(cups_job_id)
-                jobs = job_obj.with_context(active_test=False).search([
-                    ('job_id_cups', '=', cups_job_id),
-                    ('server_id', '=', server.id),
-                ])
-                job_values = {
-                    'name': job_data.get('job-name', ''),
-                    'active': True,
-                    'job_id_cups': cups_job_id,
-                    'job_media_progress': job_data.get(
-                        'job-media-progress', 0),
-                    'job_state': mapping.get(
-                        job_data.get('job-state'), 'unknown'),
-                    'job_state_reason': job_data.get('job-state-reasons', ''),
-                    'time_at_creation': fields.Datetime.to_string(
-                        datetime.fromtimestamp(job_data.get(
-                            'time-at-creation', 0))),
-                    'time_at_processing': job_data.get(
-                        'time-at-processing', 0) and fields.Datetime.to_string(
-                            datetime.fromtimestamp(job_data.get(
-                                'time-at-processing', 0))),
-                    'time_at_completed': job_data.get(
-                        'time-at-completed', 0) and fields.Datetime.to_string(
-                            datetime.fromtimestamp(job_data.get(
-                                'time-at-completed', 0))),
+                    # Read by pages, the completed jobs are sorted by date
+                    requests.append({
+                        'which_jobs': 'all',
+                        'first_job_id': oldest_uncompleted_job.job_id_cups,
+                        'requested_attributes': JOB_ATTRIBUTES,
+                    })
+
+            connections.append((server._get_connection(), requests))
+
+        # Retrieve asked job data from all servers at the same time, and
+        # write each page of jobs before reading the next one
+        full_update = which == 'all' and first_job_id == -1
+        cups_job_ids = [[] for server in self]
+        failed_servers = self.browse()
+        for index, jobs_data, error in stream_parallel(
+                _fetch_jobs, connections):
+            server = self[index]
+            if error is not None:
+                _logger.warning(
+                    'Could not get the jobs from the CUPS server (%s:%s): %s',
+                    server.address, server.port, error)
+                failed_servers |= server
+                continue
+            server._update_jobs_from_cups(jobs_data)
+            if full_update:
+                cups_job_ids[index].extend(jobs_data)
+
+        # Deactive purged jobs
+        if full_update:
+            for server, job_ids in zip(self, cups_job_ids):
+                if server in failed_servers:
+                    continue
+                last_job_id = max(job_ids or [0])
+                values = {
+                    # Job ids start over when the history of CUPS is reset
+                    'last_job_id_cups': last_job_id,
+                    'job_full_sync_date': fields.Datetime.now(),
                 }
+                if server.purged_job_id_cups > last_job_id:
+                    # Deleted ids may be used again by new jobs
+                    values['purged_job_id_cups'] = 0
+                server.write(values)
+                server._deactivate_purged_jobs(job_ids)
 
-                # Search for the printer in Odoo
-                printer_uri = job_data['printer-uri']
-                printer_system_name = printer_uri[printer_uri.rfind('/') + 1:]
-                printer = printer_obj.search([
-                    ('server_id', '=', server.id),
-                    ('system_name', '=', printer_system_name),
-                ], limit=1)
-                job_values['printer_id'] = printer.id
+        return True
 
-                if jobs:
-                    jobs.write(job_values)
-                else:
-                    job_obj.create(job_values)
+    @api.model
+    def _cron_purge_jobs(self):
+        self.search([]).filtered(
+            lambda server: server.job_retention_days or
+            server.job_retention_count)._purge_jobs()
+        return True
 
-            # Deactive purged jobs
-            if which == 'all' and first_job_id == -1:
-                purged_jobs = job_obj.search([
-                    ('job_id_cups', 'not in', list(all_cups_job_ids)),
-                ])
-                purged_jobs.write({'active': False})
+    @api.multi
+    def _purge_jobs(self, chunk_size=PURGE_CHUNK_SIZE):
+        """ Delete the jobs beyond the retention policy of the servers
+
+        Only finished jobs, and jobs purged from CUPS, are deleted. Jobs are
+        selected and deleted by chunks, each one in its own transaction, to
+        avoid holding locks on many rows for a long time. Only meant to be
+        called by the scheduler, as the transaction is committed.
+        """
+        job_obj = self.env['printing.job']
+        job_obj.check_access_rights('unlink')
+        for server in self:
+            joins = ''
+            conditions = []
+            params = {
+                'server_id': server.id,
+                'final_states': FINAL_JOB_STATES,
+                'limit': chunk_size,
+            }
+            if server.job_retention_days:
+                conditions.append('job.time_at_creation < %(date_limit)s')
+                params['date_limit'] = fields.Datetime.to_string(
+                    fields.Datetime.from_string(fields.Datetime.now()) -
+                    timedelta(days=server.job_retention_days))
+            if server.job_retention_count:
+                # Newest job of each printer beyond the retention count
+                self.env.cr.execute("""
+                    SELECT printer.id, (
+                        SELECT job_id_cups FROM printing_job
+                        WHERE server_id = %(server_id)s
+                            AND printer_id = printer.id
+                        ORDER BY job_id_cups DESC
+                        OFFSET %(count_limit)s LIMIT 1
+                    ) AS job_id_cups
+                    FROM printing_printer AS printer
+                    WHERE printer.server_id = %(server_id)s
+                """, {
+                    'server_id': server.id,
+                    'count_limit': server.job_retention_count,
+                })
+                limits = [row for row in self.env.cr.fetchall() if row[1]]
+                if limits:
+                    joins = """
+                        LEFT JOIN unnest(
+                            %(printer_ids)s::integer[],
+                            %(limit_job_ids)s::integer[]
+                        ) AS job_limit(printer_id, job_id_cups)
+                            ON job_limit.printer_id = job.printer_id
+                    """
+                    conditions.append(
+                        'job.job_id_cups <= job_limit.job_id_cups')
+                    params.update(
+                        printer_ids=[row[0] for row in limits],
+                        limit_job_ids=[row[1] for row in limits],
+                    )
+            if not conditions:
+                continue
+
+            query = """
+                DELETE FROM printing_job WHERE id IN (
+                    SELECT job.id FROM printing_job AS job
+                    {joins}
+                    WHERE job.server_id = %(server_id)s
+                        AND (NOT job.active
+                            OR job.job_state IN %(final_states)s)
+                        AND ({conditions})
+                    ORDER BY job.job_id_cups
+                    LIMIT %(limit)s
+                )
+                RETURNING id, job_id_cups
+            """.format(joins=joins, conditions=' OR '.join(conditions))
+            deleted_count = 0
+            while True:
+                self.env.cr.execute(query, params)
+                jobs = self.env.cr.fetchall()
+                if not jobs:
+                    break
+                job_obj.invalidate_cache(ids=[job[0] for job in jobs])
+                # Recorded with the deletion, so that the deleted jobs are
+                # not synchronized again from CUPS
+                server.purged_job_id_cups = max(
+                    [server.purged_job_id_cups] + [job[1] for job in jobs])
+                commit(self.env)
+                deleted_count += len(jobs)
+                if len(jobs) < chunk_size:
+                    break
+            if deleted_count:
+                _logger.info(
+                    'Deleted %d jobs of the CUPS server %s:%s',
+                    deleted_count, server.address, server.port)
+                self.env['printing.printer'].invalidate_cache(['job_ids'])
 
         return True
+
+    @api.multi
+    def _deactivate_purged_jobs(self, cups_job_ids):
+        """ Deactivate the jobs of the server which CUPS does not know anymore
+
+        `cups_job_ids` is the complete list of job ids kept by CUPS.
+        Return the ids of the deactivated jobs.
+        """
+        self.ensure_one()
+        job_obj = self.env['printing.job']
+        job_obj.check_access_rights('write')
+        self.env.cr.execute("""
+            UPDATE printing_job AS job
+            SET active = false,
+                write_uid = %s,
+                write_date = (now() at time zone 'UTC')
+            WHERE job.server_id = %s AND job.active
+                AND NOT EXISTS (
+                    SELECT 1 FROM unnest(%s::integer[]) AS cups_job(id)
+                    WHERE cups_job.id = job.job_id_cups)
+            RETURNING job.id
+        """, (self.env.uid, self.id, cups_job_ids))
+        ids = [row[0] for row in self.env.cr.fetchall()]
+        job_obj.invalidate_cache(ids=ids)
+        self.env['printing.printer'].invalidate_cache(['job_ids'])
+        return ids
+
+    @api.multi
+    def cancel_jobs(self, job_ids_cups, purge_job=False):
+        """ Cancel jobs of the server, given by their CUPS ids
+
+        All cancels are sent over a single connection, then only the
+        cancelled jobs are updated. Purged jobs are archived.
+        """
+        self.ensure_one()
+        connection = self._open_connection()
+        if not connection:
+            return False
+        try:
+            cancelled_ids, jobs_data = _cancel_jobs(
+                connection, job_ids_cups, purge_job=purge_job)
+        except Exception:
+            _logger.warning(
+                'Could not cancel jobs on %s:%s', self.address, self.port,
+                exc_info=True)
+            return False
+        self._update_jobs_from_cups(jobs_data)
+        if purge_job and cancelled_ids:
+            self.env['printing.job'].search([
+                ('server_id', '=', self.id),
+                ('job_id_cups', 'in', cancelled_ids),
+            ]).write({'job_state': 'canceled', 'active': False})
+        return True
+
+    @api.multi
+    def wait_for_job(self, job_id_cups, timeout):
+        """ Wait for a job of the server to finish
+
+        Only this job is read from CUPS, until it reaches a final state or
+        `timeout` seconds elapsed, then it is updated. Return the state of
+        the job, or False when it could not be read.
+        """
+        self.ensure_one()
+        connection = self._open_connection()
+        if not connection:
+            return False
+        try:
+            job_data = _wait_for_job(connection, job_id_cups, timeout)
+        except Exception:
+            _logger.warning(
+                'Could not wait for job %d on %s:%s',
+                job_id_cups, self.address, self.port, exc_info=True)
+            return False
+        self._update_jobs_from_cups({job_id_cups: job_data})
+        return self.env['printing.job']._prepare_update_from_cups(
+            job_id_cups, job_data)['job_state']
+
+    @api.multi
+    def _update_jobs_from_cups(self, jobs_data):
+        """ Create or update the jobs of the server from CUPS data
+
+        `jobs_data` maps CUPS job ids to their attributes, as returned by
+        ``getJobs``. Return the ids of the created or modified jobs.
+        """
+        self.ensure_one()
+        job_obj = self.env['printing.job']
+        printer_names = dict(
+            (cups_job_id, job_data['printer-uri'][
+                job_data['printer-uri'].rfind('/') + 1:])
+            for cups_job_id, job_data in jobs_data.items())
+        printers = dict(
+            (printer.system_name, printer.id) for printer in self.printer_ids)
+        missing_printers = set(printer_names.values()) - set(printers)
+        if missing_printers:
+            # Printers are not updated as often as jobs: only link the jobs to
+            # new records, whose settings are read by the next printer update
+            printer_obj = self.env['printing.printer']
+            for system_name in sorted(missing_printers):
+                printers[system_name] = printer_obj.create({
+                    'name': system_name,
+                    'system_name': system_name,
+                    'server_id': self.id,
+                }).id
+            self.printer_update_date = False
+
+        # Finished jobs deleted by the retention policy must not come back
+        deleted_job_ids = set()
+        if self.purged_job_id_cups:
+            deleted_job_ids = set(
+                job_id for job_id in jobs_data
+                if job_id <= self.purged_job_id_cups)
+        if deleted_job_ids:
+            deleted_job_ids -= set(job_obj.with_context(
+                active_test=False,
+            ).search([
+                ('server_id', '=', self.id),
+                ('job_id_cups', 'in', list(deleted_job_ids)),
+            ]).mapped('job_id_cups'))
+
+        values_list = []
+        for cups_job_id, job_data in jobs_data.items():
+            job_values = job_obj._prepare_update_from_cups(
+                cups_job_id, job_data)
+            if cups_job_id in deleted_job_ids and \
+                    job_values['job_state'] in FINAL_JOB_STATES:
+                continue
+
+            job_values.update(
+                printer_id=printers[printer_names[cups_job_id]],
+                server_id=self.id,
+            )
+            values_list.append(job_values)
+
+        job_ids = job_obj._bulk_upsert(values_list)
+        self.env['printing.job.statistics']._add_jobs(job_ids)
+        return job_ids
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+import logging
+from datetime import timedelta
+
+from odoo import models, fields, api
+
+from ..cups_connection import run_parallel
+from ..tools import commit
+from .printing_printer import _send_document
+
+_logger = logging.getLogger(__name__)
+
+# Number of documents sent to CUPS at the same time
+SPOOL_BATCH_SIZE = 16
+# Number of attempts to send a document before giving up
+SPOOL_MAX_ATTEMPTS = 6
+# Seconds to wait before the second attempt, doubled after each attempt
+SPOOL_BACKOFF = 60
+
+
+def _send_spooled_document(document):
+    """ Network part of the sending of a spooled document
+
+    Runs outside of the environment's thread.
+    """
+    return _send_document(**document)
+
+
+class PrintingSpool(models.Model):
+    _name = 'printing.spool'
+    _description = 'Print Spool Entry'
+    _order = 'id DESC'
+
+    name = fields.Char(required=True, readonly=True, help='Document name.')
+    printer_id = fields.Many2one(
+        comodel_name='printing.printer', string='Printer', required=True,
+        readonly=True, ondelete='cascade',
+        help='Printer the document is sent to.')
+    report_id = fields.Many2one(
+        comodel_name='ir.actions.report.xml', string='Report', readonly=True,
+        ondelete='set null', help='Report which produced the document.')
+    document = fields.Binary(attachment=True, readonly=True)
+    format = fields.Char(readonly=True, help='Format of the document.')
+    copies = fields.Integer(default=1, readonly=True)
+    user_id = fields.Many2one(
+        comodel_name='res.users', string='User', readonly=True,
+        default=lambda self: self.env.user,
+        help='User who printed the document.')
+    state = fields.Selection(
+        selection=[
+            ('pending', 'Pending'),
+            ('done', 'Sent'),
+            ('failed', 'Failed'),
+        ], required=True, default='pending', readonly=True, index=True)
+    attempt_count = fields.Integer(
+        string='Attempts', readonly=True,
+        help='Number of failed attempts to send the document.')
+    next_attempt_date = fields.Datetime(
+        readonly=True, default=fields.Datetime.now,
+        help='Date after which the document will be sent again.')
+    error = fields.Text(
+        readonly=True, help='Error of the last attempt to send the document.')
+    res_model = fields.Char(
+        string='Model', readonly=True, help='Model of the printed records.')
+    res_ids = fields.Char(
+        string='Records', readonly=True,
+        help='Comma separated ids of the printed records.')
+    job_id = fields.Many2one(
+        comodel_name='printing.job', string='Job', readonly=True,
+        ondelete='set null', help='Job of the printed document.')
+
+    @api.model
+    def enqueue(self, printer, report, content, format, copies=1,
+                title=None, res_model=None, res_ids=None):
+        """ Record a document to be sent later to `printer`
+
+        Arguments are the ones of `printing.printer.print_document`, but
+        the content must be bytes.
+        """
+        return self.sudo().create({
+            'name': printer._prepare_document(
+                report, format, copies=copies, title=title)['title'],
+            'printer_id': printer.id,
+            'report_id': getattr(report, 'id', False),
+            'document': base64.b64encode(content),
+            'format': format,
+            'copies': copies,
+            'res_model': res_model or getattr(report, 'model', False),
+            'res_ids': res_ids and ','.join(map(str, res_ids)) or False,
+            'user_id': self.env.uid,
+        })
+
+    @api.multi
+    def action_retry(self):
+        self.write({
+            'state': 'pending',
+            'attempt_count': 0,
+            'next_attempt_date': fields.Datetime.now(),
+        })
+        return True
+
+    @api.model
+    def _cron_process_spool(self):
+        """ Send the pending documents whose next attempt is due
+
+        Only meant to be called by the scheduler, as each batch of
+        documents is committed.
+        """
+        while True:
+            # Entries being sent by another worker are skipped
+            self.env.cr.execute("""
+                SELECT id FROM printing_spool
+                WHERE state = 'pending' AND next_attempt_date <= %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (fields.Datetime.now(), SPOOL_BATCH_SIZE))
+            entries = self.browse([row[0] for row in self.env.cr.fetchall()])
+            if not entries:
+                return True
+            entries._send()
+            commit(self.env)
+            if len(entries) < SPOOL_BATCH_SIZE:
+                return True
+
+    @api.multi
+    def _send(self):
+        """ Send the documents to their printers, all at the same time
+
+        Failed entries are tried again later, with an increasing delay.
+        The outcome of the sending is committed before the jobs are
+        recorded, so that an error afterwards cannot send documents twice.
+        The documents sent are not kept.
+        """
+        documents = []
+        for entry in self:
+            document = entry.printer_id._prepare_document(
+                entry.report_id or None, entry.format, copies=entry.copies,
+                title=entry.name)
+            document.update(
+                connection=entry.printer_id.server_id._get_connection(),
+                content=base64.b64decode(entry.document or ''),
+            )
+            documents.append(document)
+        results = run_parallel(_send_spooled_document, documents)
+
+        now = fields.Datetime.from_string(fields.Datetime.now())
+        for entry, (job_id, error) in zip(self, results):
+            if error is None:
+                entry.write({
+                    'state': 'done',
+                    'error': False,
+                    'document': False,
+                })
+                continue
+
+            _logger.warning(
+                'Could not send the spooled document %d to %s: %s',
+                entry.id, entry.printer_id.name, error)
+            attempt_count = entry.attempt_count + 1
+            entry.write({
+                'state': 'failed' if attempt_count >= SPOOL_MAX_ATTEMPTS
+                else 'pending',
+                'attempt_count': attempt_count,
+                'next_attempt_date': fields.Datetime.to_string(
+                    now + timedelta(
+                        seconds=SPOOL_BACKOFF * 2 ** (attempt_count - 1))),
+                'error': '%s' % (error, ),
+            })
+        commit(self.env)
+
+        for entry, (job_id, error) in zip(self, results):
+            if error is not None:
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    entry.job_id = entry.printer_id._create_job(
+                        job_id, entry.name, report=entry.report_id,
+                        res_model=entry.res_model,
+                        res_ids=entry.res_ids and map(
+                            int, entry.res_ids.split(',')),
+                        user=entry.user_id)
+            except Exception:
+                _logger.exception(
+                    'Could not record the job of the spooled document %d',
+                    entry.id)
+        return True
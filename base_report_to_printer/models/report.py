@@ -15,12 +15,37 @@ class Report(models.Model):
             record_ids, report_name, html=html, data=data)
         report = self._get_report_from_name(report_name)
         behaviour = report.behaviour()[report.id]
-        printer = behaviour['printer']
+        printer = self._get_printer(behaviour)
         if not printer:
             raise exceptions.Warning(
                 _('No printer configured to print this report.')
             )
-        return printer.print_document(report, document, report.report_type)
+        self._send_to_printer(printer, report, document, record_ids)
+        return True
+
+    @api.model
+    def _get_printer(self, behaviour):
+        """ Return the printer to use for a behaviour of a report
+
+        The printer of a pool is selected each time a document is printed.
+        A printer which cannot print is replaced by its failover printer.
+        """
+        printer = behaviour['printer']
+        if behaviour.get('printer_pool'):
+            printer = behaviour['printer_pool'].select_printer()
+        if printer:
+            printer = printer._get_available_printer()
+        return printer
+
+    @api.model
+    def _send_to_printer(self, printer, report, document, record_ids):
+        """ Print the document, or queue it for printers using a spool """
+        if printer.spool:
+            return self.env['printing.spool'].enqueue(
+                printer, report, document, report.report_type,
+                res_ids=record_ids)
+        return printer.print_document(
+            report, document, report.report_type, res_ids=record_ids)
 
     @api.multi
     def _can_print_report(self, behaviour, printer, document):
@@ -48,9 +73,11 @@ class Report(models.Model):
         report = self._get_report_from_name(report_name)
         behaviour = report.behaviour()[report.id]
         printer = behaviour['printer']
+        if behaviour['action'] == 'server':
+            printer = self._get_printer(behaviour)
         can_print_report = self._can_print_report(behaviour, printer, document)
 
         if can_print_report:
-            printer.print_document(report, document, report.report_type)
+            self._send_to_printer(printer, report, document, docids)
 
         return document
@@ -26,3 +26,20 @@ class ResUsers(models.Model):
     )
     printing_printer_id = fields.Many2one(comodel_name='printing.printer',
                                           string='Default Printer')
+    printing_printer_pool_id = fields.Many2one(
+        comodel_name='printing.printer.pool', string='Default Printer Pool')
+
+    @api.model
+    def _printing_behaviour_fields(self):
+        """ Return the fields whose changes modify the printing behaviours """
+        return {
+            'printing_action',
+            'printing_printer_id',
+            'printing_printer_pool_id',
+        }
+
+    @api.multi
+    def write(self, vals):
+        if set(vals) & self._printing_behaviour_fields():
+            self.env['ir.actions.report.xml'].clear_caches()
+        return super(ResUsers, self).write(vals)
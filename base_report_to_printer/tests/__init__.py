@@ -2,9 +2,13 @@
 # Copyright 2016 LasLabs Inc.
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from . import test_cups_connection
 from . import test_printing_job
+from . import test_printing_job_statistics
 from . import test_printing_printer
+from . import test_printing_printer_pool
 from . import test_printing_server
+from . import test_printing_spool
 from . import test_report
 from . import test_res_users
 from . import test_ir_actions_report_xml
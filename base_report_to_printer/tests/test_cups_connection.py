@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import threading
+import time
+
+import mock
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.base_report_to_printer import cups_connection
+
+
+class TestConnectionPool(TransactionCase):
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.pool = cups_connection.ConnectionPool(
+            ('localhost', 631), max_size=2, wait_timeout=0)
+        self.factory = mock.MagicMock(
+            side_effect=lambda: mock.MagicMock())
+
+    def test_reuse_connection(self):
+        """ It should give back the same connection when borrowed twice """
+        with self.pool.connection(self.factory) as first:
+            pass
+        with self.pool.connection(self.factory) as second:
+            pass
+        self.assertIs(first, second)
+        self.assertEqual(self.factory.call_count, 1)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_discard_on_error(self):
+        """ It should not reuse a connection which raised an error """
+        with self.assertRaises(ValueError):
+            with self.pool.connection(self.factory):
+                raise ValueError
+        self.assertEqual(len(self.pool), 0)
+        with self.pool.connection(self.factory):
+            pass
+        self.assertEqual(self.factory.call_count, 2)
+
+    def test_max_size(self):
+        """ It should not open more connections than allowed """
+        with self.pool.connection(self.factory):
+            with self.pool.connection(self.factory):
+                with self.assertRaises(cups_connection.PoolExhausted):
+                    self.pool.acquire(self.factory)
+
+    def test_idle_eviction(self):
+        """ It should close connections idle for too long """
+        with self.pool.connection(self.factory):
+            pass
+        self.pool.idle_timeout = -1
+        with self.pool.connection(self.factory):
+            pass
+        self.assertEqual(self.factory.call_count, 2)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_health_check(self):
+        """ It should replace a stale connection failing its check """
+        with self.pool.connection(self.factory) as connection:
+            connection.getDefault.side_effect = Exception
+        self.pool.check_interval = -1
+        with self.pool.connection(self.factory) as new_connection:
+            pass
+        self.assertIsNot(connection, new_connection)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_factory_error(self):
+        """ It should free the slot when the connection cannot be opened """
+        self.factory.side_effect = Exception
+        with self.assertRaises(Exception):
+            self.pool.acquire(self.factory)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_pooled_connection(self):
+        """ It should forward calls to a borrowed connection """
+        connection = cups_connection.PooledConnection(self.pool, self.factory)
+        connection.getPrinters()
+        connection.getJobs(which_jobs='all')
+        self.assertEqual(self.factory.call_count, 1)
+        with self.pool.connection(self.factory) as cups:
+            cups.getPrinters.assert_called_once_with()
+            cups.getJobs.assert_called_once_with(which_jobs='all')
+
+    def test_get_pool(self):
+        """ It should share pools by address and port """
+        self.addCleanup(cups_connection.clear_pools)
+        pool = cups_connection.get_pool('localhost', 631)
+        self.assertIs(pool, cups_connection.get_pool('localhost', 631))
+        self.assertIsNot(pool, cups_connection.get_pool('localhost', 632))
+
+
+class TestCircuitBreaker(TransactionCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.breaker = cups_connection.CircuitBreaker(
+            threshold=2, backoff=10, max_backoff=15)
+
+    def test_open_after_threshold(self):
+        """ It should refuse attempts after consecutive failures """
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, self.breaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        """ It should only count consecutive failures """
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_probe(self):
+        """ It should let a single probe through after the backoff """
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.retry_at = 0
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, self.breaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, self.breaker.CLOSED)
+
+    def test_half_open_failure(self):
+        """ It should double the backoff when the probe fails """
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.retry_at = 0
+        self.breaker.allow()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, self.breaker.OPEN)
+        self.assertEqual(self.breaker.backoff, 15)
+        self.assertFalse(self.breaker.allow())
+
+    def test_pool_fails_fast(self):
+        """ It should not call the factory while the breaker is open """
+        pool = cups_connection.ConnectionPool(('localhost', 631))
+        factory = mock.MagicMock(side_effect=Exception)
+        for attempt in range(cups_connection.BREAKER_THRESHOLD):
+            with self.assertRaises(Exception):
+                pool.acquire(factory)
+        with self.assertRaises(cups_connection.ServerUnavailable):
+            pool.acquire(factory)
+        self.assertEqual(
+            factory.call_count, cups_connection.BREAKER_THRESHOLD)
+
+
+class TestCallWithTimeout(TransactionCase):
+
+    def setUp(self):
+        super(TestCallWithTimeout, self).setUp()
+        self.event = threading.Event()
+        self.addCleanup(self.event.set)
+
+    def test_return_value(self):
+        """ It should return the result of the call """
+        self.assertEqual(
+            cups_connection.call_with_timeout(lambda x: x * 2, 1, 21), 42)
+
+    def test_raise_error(self):
+        """ It should raise the error of the call """
+        with self.assertRaises(ValueError):
+            cups_connection.call_with_timeout(int, 1, 'not a number')
+
+    def test_timeout(self):
+        """ It should give up on calls which take too long """
+        with self.assertRaises(cups_connection.OperationTimeout):
+            cups_connection.call_with_timeout(self.event.wait, 0.01)
+
+    def test_pooled_connection_timeout(self):
+        """ It should drop the connection and count a server failure """
+        pool = cups_connection.ConnectionPool(('localhost', 631))
+        factory = mock.MagicMock()
+        factory.return_value.getPrinters.side_effect = self.event.wait
+        connection = cups_connection.PooledConnection(
+            pool, factory, connect_timeout=1, call_timeout=0.01)
+        with self.assertRaises(cups_connection.OperationTimeout):
+            connection.getPrinters()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.breaker.failures, 1)
+
+    def test_pooled_connection_run(self):
+        """ It should run an operation of several calls in a single thread """
+        pool = cups_connection.ConnectionPool(('localhost', 631))
+        factory = mock.MagicMock()
+        connection = cups_connection.PooledConnection(
+            pool, factory, call_timeout=1)
+
+        def send(session, chunks):
+            for chunk in chunks:
+                session.writeRequestData(chunk, len(chunk))
+            return session.finishDocument('printer')
+
+        factory.return_value.finishDocument.return_value = 'done'
+        with mock.patch.object(
+                cups_connection.threading, 'Thread',
+                wraps=threading.Thread) as thread:
+            result = connection.run(send, ['a', 'b', 'c'])
+        self.assertEqual(result, 'done')
+        self.assertEqual(thread.call_count, 1)
+        self.assertEqual(
+            factory.return_value.writeRequestData.call_count, 3)
+
+    def test_pooled_connection_run_long(self):
+        """ It should bound each call, not the whole operation """
+        pool = cups_connection.ConnectionPool(('localhost', 631))
+        factory = mock.MagicMock()
+        factory.return_value.cancelJob.side_effect = \
+            lambda job_id: time.sleep(0.02)
+        connection = cups_connection.PooledConnection(
+            pool, factory, call_timeout=0.05)
+
+        def cancel(session, job_ids):
+            for job_id in job_ids:
+                session.cancelJob(job_id)
+            return len(job_ids)
+
+        self.assertEqual(connection.run(cancel, range(5)), 5)
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.breaker.failures, 0)
+
+
+class TestParallel(TransactionCase):
+
+    def test_run_parallel(self):
+        """ It should return results and errors in the order of arguments """
+        outcomes = cups_connection.run_parallel(
+            lambda value: 10 // value, [1, 0, 5], max_workers=2)
+        self.assertEqual(outcomes[0], (10, None))
+        self.assertIsNone(outcomes[1][0])
+        self.assertIsInstance(outcomes[1][1], ZeroDivisionError)
+        self.assertEqual(outcomes[2], (2, None))
+
+    def test_run_parallel_concurrency(self):
+        """ It should run the calls at the same time """
+        barrier = threading.Event()
+        started = []
+        lock = threading.Lock()
+
+        def wait(value):
+            with lock:
+                started.append(value)
+                if len(started) == 3:
+                    barrier.set()
+            return barrier.wait(1)
+
+        outcomes = cups_connection.run_parallel(wait, [1, 2, 3])
+        self.assertEqual(outcomes, [(True, None)] * 3)
+
+    def test_prefetched_connection(self):
+        """ It should serve prefetched results once, then forward calls """
+        connection = mock.MagicMock()
+        connection.getPPD3.return_value = 'prefetched'
+        results = cups_connection.prefetch(
+            connection, [('getPPD3', ('printer',))])
+        connection.getPPD3.return_value = 'live'
+        prefetched = cups_connection.PrefetchedConnection(connection, results)
+        self.assertEqual(prefetched.getPPD3('printer'), 'prefetched')
+        self.assertEqual(prefetched.getPPD3('printer'), 'live')
+        self.assertEqual(prefetched.getPPD3('other'), 'live')
+
+    def test_stream_parallel(self):
+        """ It should yield the items of each argument in order """
+        def generate(value):
+            for item in range(value):
+                yield item
+            if value == 2:
+                raise ValueError
+
+        outcomes = list(cups_connection.stream_parallel(
+            generate, [3, 2], max_workers=2, queue_size=1))
+        self.assertEqual(
+            [item for index, item, error in outcomes if index == 0],
+            [0, 1, 2])
+        self.assertEqual(
+            [item for index, item, error in outcomes if index == 1],
+            [0, 1, None])
+        errors = [error for index, item, error in outcomes if error]
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
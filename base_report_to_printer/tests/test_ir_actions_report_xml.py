@@ -72,7 +72,8 @@ class TestIrActionsReportXml(TransactionCase):
             ]
             expect = {
                 'action': behaviour['action'],
-                'printer_name': behaviour['printer'].name,
+                'printer_name': (
+                    behaviour['printer_pool'] or behaviour['printer']).name,
             }
             self.assertDictEqual(
                 expect, res,
@@ -90,6 +91,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': 'client',
                 'printer': self.env['printing.printer'],
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -102,6 +104,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': 'client',
                 'printer': self.env.user.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -115,6 +118,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': report.property_printing_action_id.action_type,
                 'printer': report.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -127,6 +131,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': 'client',
                 'printer': report.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -143,6 +148,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': 'client',
                 'printer': report.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -160,6 +166,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': 'client',
                 'printer': report.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -175,6 +182,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': printing_action.action,
                 'printer': report.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -189,6 +197,7 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': printing_action.action,
                 'printer': printing_action.printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
 
@@ -204,5 +213,134 @@ class TestIrActionsReportXml(TransactionCase):
             report.id: {
                 'action': 'client',
                 'printer': report.printing_printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
             },
         })
+
+    def test_behaviour_printer_pool(self):
+        """ It should return the pool of the report instead of a printer """
+        report = self.Model.search([], limit=1)
+        self.env.user.printing_action = 'client'
+        self.env.user.printing_printer_id = self.new_printer()
+        report.printing_printer_pool_id = self.env[
+            'printing.printer.pool'].create({'name': 'Pool'})
+        self.assertEqual(report.behaviour(), {
+            report.id: {
+                'action': 'client',
+                'printer': self.env['printing.printer'],
+                'printer_pool': report.printing_printer_pool_id,
+            },
+        })
+
+    def test_behaviour_printing_action_printer_over_pool(self):
+        """ It should prefer the printer of the printing action to a pool """
+        report = self.Model.search([], limit=1)
+        report.printing_printer_pool_id = self.env[
+            'printing.printer.pool'].create({'name': 'Pool'})
+        printing_action = self.new_printing_action()
+        printing_action.user_id = self.env.user
+        printing_action.printer_id = self.new_printer()
+        self.assertEqual(report.behaviour(), {
+            report.id: {
+                'action': printing_action.action,
+                'printer': printing_action.printer_id,
+                'printer_pool': self.env['printing.printer.pool'],
+            },
+        })
+
+    def test_behaviour_cache(self):
+        """ It should resolve the behaviour once until settings change """
+        report = self.Model.search([], limit=1)
+        self.env.user.printing_action = 'client'
+        report.behaviour()
+        with mock.patch.object(type(report), '_resolve_behaviour') as resolve:
+            report.behaviour()
+            resolve.assert_not_called()
+
+        self.env.user.printing_printer_id = self.new_printer()
+        self.assertEqual(
+            report.behaviour()[report.id]['printer'],
+            self.env.user.printing_printer_id)
+        printing_action = self.new_printing_action()
+        printing_action.user_id = self.env.user
+        printing_action.printer_id = self.new_printer()
+        self.assertEqual(
+            report.behaviour()[report.id]['printer'],
+            printing_action.printer_id)
+        printing_action.unlink()
+        report.printing_printer_id = self.new_printer()
+        self.assertEqual(
+            report.behaviour()[report.id]['printer'],
+            report.printing_printer_id)
+
+    def test_behaviour_cache_property(self):
+        """ It should resolve the behaviour again when a property changes """
+        report = self.Model.search([], limit=1)
+        self.env.user.printing_action = 'client'
+        self.env['ir.property'].search([
+            ('name', '=', 'property_printing_action_id'),
+            ('res_id', '=', 'ir.actions.report.xml,%d' % report.id),
+        ]).unlink()
+        self.assertEqual(report.behaviour()[report.id]['action'], 'client')
+        self.env.ref(
+            'base_report_to_printer.property_printing_action_id',
+        ).value_reference = 'printing.action,%d' % self.env.ref(
+            'base_report_to_printer.printing_action_1').id
+        self.env.invalidate_all()
+        self.assertEqual(report.behaviour()[report.id]['action'], 'server')
+
+    def test_behaviour_cache_archived_pool(self):
+        """ It should stop using a pool once it is archived """
+        report = self.Model.search([], limit=1)
+        self.env.user.printing_action = 'client'
+        report.printing_printer_id = self.new_printer()
+        report.printing_printer_pool_id = self.env[
+            'printing.printer.pool'].create({'name': 'Pool'})
+        self.assertEqual(
+            report.behaviour()[report.id]['printer_pool'],
+            report.printing_printer_pool_id)
+        report.printing_printer_pool_id.active = False
+        self.assertEqual(report.behaviour()[report.id], {
+            'action': 'client',
+            'printer': report.printing_printer_id,
+            'printer_pool': self.env['printing.printer.pool'],
+        })
+
+    def test_behaviour_cache_per_user(self):
+        """ It should not share the cached behaviours between users """
+        report = self.Model.search([], limit=1)
+        self.env.user.printing_action = 'server'
+        demo_user = self.env.ref('base.user_demo')
+        demo_user.write({
+            'printing_action': 'client',
+            'groups_id': [(4, self.env.ref(
+                'base_report_to_printer.printing_group_user').id)],
+        })
+        self.assertEqual(report.behaviour()[report.id]['action'], 'server')
+        self.assertEqual(
+            report.sudo(demo_user).behaviour()[report.id]['action'],
+            'client')
+
+    def test_behaviour_batch(self):
+        """ It should resolve many reports with as many queries as one """
+        reports = self.Model.search([], limit=5)
+        for report in reports:
+            self.env['printing.report.xml.action'].create({
+                'report_id': report.id,
+                'user_id': self.env.uid,
+                'action': 'server',
+            })
+
+        def count_queries(reports):
+            self.env.invalidate_all()
+            count = self.cr.sql_log_count
+            behaviours = reports._resolve_behaviour()
+            return behaviours, self.cr.sql_log_count - count
+
+        behaviours, single_count = count_queries(reports[:1])
+        behaviours, batch_count = count_queries(reports)
+        self.assertEqual(batch_count, single_count)
+        self.assertEqual(
+            set(behaviour['action'] for behaviour in behaviours.values()),
+            {'server'})
+        self.assertEqual(reports.behaviour(), behaviours)
@@ -5,16 +5,24 @@
 import mock
 
 from odoo import fields
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
 
 
 model = 'odoo.addons.base_report_to_printer.models.printing_server'
 
 
+class IPPError(Exception):
+    pass
+
+
 class TestPrintingJob(TransactionCase):
 
     def setUp(self):
         super(TestPrintingJob, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['printing.server']
         self.server = self.Model.create({})
         self.printer_vals = {
@@ -51,16 +59,130 @@ class TestPrintingJob(TransactionCase):
         cups.Connection.side_effect = Exception
         printer = self.new_printer()
         job = self.new_job(printer, {'job_id_cups': 2})
-        job.action_cancel()
+        with self.assertRaises(UserError):
+            job.action_cancel()
         cups.Connection.side_effect = None
         self.assertEquals(cups.Connection().cancelJob.call_count, 0)
 
     @mock.patch('%s.cups' % model)
     def test_cancel_job(self, cups):
         """ It should catch any exception from CUPS and update status """
+        cups.Connection().getJobAttributes.return_value = {
+            'printer-uri': 'ipp://localhost/printers/Sys Name',
+            'time-at-creation': 1000,
+            'job-state': 7,
+        }
         printer = self.new_printer()
         job = self.new_job(printer)
         job.cancel()
         cups.Connection().cancelJob.assert_called_once_with(
             job.job_id_cups, purge_job=False,
         )
+        self.assertEqual(job.job_state, 'canceled')
+
+    @mock.patch('%s.cups' % model)
+    def test_cancel_jobs(self, cups):
+        """ It should cancel jobs together and only read them again """
+        cups.Connection().getJobAttributes.return_value = {
+            'printer-uri': 'ipp://localhost/printers/Sys Name',
+            'time-at-creation': 1000,
+            'job-state': 7,
+        }
+        cups.Connection().cancelJob.side_effect = [None, Exception, None]
+        printer = self.new_printer()
+        jobs = self.env['printing.job']
+        for job_id_cups in (1, 2, 3):
+            jobs |= self.new_job(printer, {
+                'job_id_cups': job_id_cups,
+                'job_state': 'pending',
+            })
+        cups.Connection.reset_mock()
+        jobs.cancel()
+        self.assertEqual(cups.Connection.call_count, 1)
+        self.assertEqual(cups.Connection().cancelJob.call_count, 3)
+        self.assertEqual(cups.Connection().getJobAttributes.call_count, 2)
+        cups.Connection().getJobs.assert_not_called()
+        cups.Connection().getPrinters.assert_not_called()
+        self.assertEqual(
+            jobs.mapped('job_state'), ['canceled', 'pending', 'canceled'])
+
+    @mock.patch('%s.cups' % model)
+    def test_cancel_jobs_read_error(self, cups):
+        """ It should keep the cancelled jobs it could not read again """
+        cups.IPPError = IPPError
+        cups.IPP_NOT_FOUND = 0x0406
+        cups.Connection().getJobAttributes.side_effect = IPPError(
+            0x0500, 'Internal error')
+        printer = self.new_printer()
+        job = self.new_job(printer, {'job_state': 'pending'})
+        with mock.patch('%s._logger' % model) as logger:
+            job.cancel()
+        cups.Connection().cancelJob.assert_called_once_with(
+            1, purge_job=False)
+        logger.warning.assert_called_once_with(
+            'Could not read job %d: %s', 1, mock.ANY)
+        self.assertTrue(job.active)
+        self.assertEqual(job.job_state, 'pending')
+
+    @mock.patch('%s.cups' % model)
+    def test_cancel_purge_job(self, cups):
+        """ It should archive the purged jobs """
+        printer = self.new_printer()
+        job = self.new_job(printer, {'job_state': 'pending'})
+        job.cancel(purge_job=True)
+        cups.Connection().getJobAttributes.assert_not_called()
+        self.assertFalse(job.active)
+        self.assertEqual(job.job_state, 'canceled')
+
+    def upsert_values(self, printer, **kwargs):
+        values = dict(self.job_vals, **{
+            'name': 'Job',
+            'active': True,
+            'printer_id': printer.id,
+            'job_state': 'pending',
+        })
+        values.update(kwargs)
+        return values
+
+    def test_bulk_upsert_create(self):
+        """ It should create the unknown jobs """
+        printer = self.new_printer()
+        ids = self.env['printing.job']._bulk_upsert([
+            self.upsert_values(printer, job_id_cups=1),
+            self.upsert_values(printer, job_id_cups=2),
+        ])
+        jobs = self.env['printing.job'].browse(ids)
+        self.assertEqual(sorted(jobs.mapped('job_id_cups')), [1, 2])
+        self.assertEqual(jobs.mapped('server_id'), self.server)
+        self.assertEqual(printer.job_ids, jobs)
+
+    def test_bulk_upsert_update(self):
+        """ It should update the known jobs and invalidate the cache """
+        printer = self.new_printer()
+        job = self.new_job(printer, {'name': 'Job', 'job_state': 'pending'})
+        ids = self.env['printing.job']._bulk_upsert([
+            self.upsert_values(printer, job_state='completed'),
+        ])
+        self.assertEqual(ids, [job.id])
+        self.assertEqual(job.job_state, 'completed')
+
+    def test_bulk_upsert_unchanged(self):
+        """ It should not modify the jobs which did not change """
+        printer = self.new_printer()
+        self.new_job(printer, {'name': 'Job', 'job_state': 'pending'})
+        ids = self.env['printing.job']._bulk_upsert([
+            self.upsert_values(printer),
+        ])
+        self.assertEqual(ids, [])
+
+    def test_prepare_update_from_cups_state_reasons(self):
+        """ It should keep the main state reason, if any """
+        job_obj = self.env['printing.job']
+        values = job_obj._prepare_update_from_cups(1, {
+            'job-state-reasons': ['job-printing', 'job-incoming'],
+        })
+        self.assertEqual(values['job_state_reason'], 'job-printing')
+        values = job_obj._prepare_update_from_cups(1, {
+            'job-state-reasons': [],
+        })
+        self.assertFalse(values['job_state_reason'])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import mock
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
+
+
+model = 'odoo.addons.base_report_to_printer.models.printing_server'
+
+
+class TestPrintingJobStatistics(TransactionCase):
+
+    def setUp(self):
+        super(TestPrintingJobStatistics, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
+        self.server = self.env['printing.server'].create({})
+        self.printer = self.env['printing.printer'].create({
+            'name': 'Printer',
+            'server_id': self.server.id,
+            'system_name': 'Sys Name',
+            'default': True,
+            'status': 'unknown',
+            'status_message': 'Msg',
+            'model': 'res.users',
+            'location': 'Location',
+            'uri': 'URI',
+        })
+        self.printer_uri = 'hostname:port/' + self.printer.system_name
+        self.Model = self.env['printing.job.statistics']
+
+    def cups_job(self, state, **kwargs):
+        job = {
+            'printer-uri': self.printer_uri,
+            'job-state': state,
+            'time-at-creation': 1500000000,
+        }
+        job.update(kwargs)
+        return job
+
+    def statistics(self):
+        return self.Model.search([('printer_id', '=', self.printer.id)])
+
+    @mock.patch('%s.cups' % model)
+    def test_count_finished_jobs(self, cups):
+        """ It should aggregate the finished jobs by state and reason """
+        cups.Connection().getJobs.return_value = {
+            1: self.cups_job(
+                9, **{
+                    'time-at-processing': 1500000010,
+                    'time-at-completed': 1500000040,
+                    'job-impressions-completed': 2,
+                    'job-state-reasons': 'job-completed-successfully',
+                }),
+            2: self.cups_job(
+                9, **{
+                    'time-at-processing': 1500000030,
+                    'time-at-completed': 1500000040,
+                    'job-impressions-completed': 3,
+                    'job-state-reasons': 'job-completed-successfully',
+                }),
+            3: self.cups_job(8),
+            4: self.cups_job(5),
+        }
+        self.server.update_jobs()
+        completed = self.statistics().filtered(
+            lambda stats: stats.job_state == 'completed')
+        self.assertEqual(completed.job_count, 2)
+        self.assertEqual(completed.page_count, 5)
+        self.assertEqual(
+            completed.job_state_reason, 'job-completed-successfully')
+        self.assertEqual(completed.average_queue_time, 20)
+        self.assertEqual(completed.average_processing_time, 20)
+        aborted = self.statistics().filtered(
+            lambda stats: stats.job_state == 'aborted')
+        self.assertEqual(aborted.job_count, 1)
+        self.assertEqual(aborted.job_state_reason, 'none')
+        self.assertEqual(
+            len(self.statistics()), 2, 'Open jobs should not be counted')
+
+    @mock.patch('%s.cups' % model)
+    def test_count_jobs_once(self, cups):
+        """ It should count each job once, when it reaches a final state """
+        cups.Connection().getJobs.return_value = {1: self.cups_job(5)}
+        self.server.update_jobs()
+        self.assertFalse(self.statistics())
+        cups.Connection().getJobs.return_value = {1: self.cups_job(9)}
+        self.server.update_jobs()
+        cups.Connection().getJobs.return_value = {
+            1: self.cups_job(9, **{'job-name': 'Renamed'}),
+        }
+        self.server.update_jobs()
+        self.assertEqual(self.statistics().job_count, 1)
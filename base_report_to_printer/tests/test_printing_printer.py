@@ -2,21 +2,30 @@
 # Copyright 2016 LasLabs Inc.
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-import tempfile
+import base64
+import io
 import mock
 
-from odoo.exceptions import UserError
+from odoo.exceptions import UserError, ValidationError
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
+from odoo.addons.base_report_to_printer.tools import changed_values
 
 
 model = 'odoo.addons.base_report_to_printer.models.printing_printer'
 server_model = 'odoo.addons.base_report_to_printer.models.printing_server'
 
 
+class IPPError(Exception):
+    pass
+
+
 class TestPrintingPrinter(TransactionCase):
 
     def setUp(self):
         super(TestPrintingPrinter, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['printing.printer']
         self.ServerModel = self.env['printing.server']
         self.server = self.env['printing.server'].create({})
@@ -35,6 +44,12 @@ class TestPrintingPrinter(TransactionCase):
     def new_record(self):
         return self.Model.create(self.printer_vals)
 
+    def set_printer_status(self, cups, state=3):
+        cups.Connection().getPrinterAttributes.return_value = {
+            'printer-state': state,
+            'printer-state-message': '',
+        }
+
     def test_printing_options(self):
         """ It should generate the right options dictionnary """
         self.assertEquals(self.Model.print_options('report', 'raw'), {
@@ -51,35 +66,159 @@ class TestPrintingPrinter(TransactionCase):
     @mock.patch('%s.cups' % server_model)
     def test_print_report(self, cups):
         """ It should print a report through CUPS """
-        fd, file_name = tempfile.mkstemp()
-        with mock.patch('%s.mkstemp' % model) as mkstemp:
-            mkstemp.return_value = fd, file_name
-            printer = self.new_record()
+        cups.Connection().createJob.return_value = 42
+        printer = self.new_record()
+        job = printer.print_document(
+            'report_name', 'content to print', 'pdf',
+            res_model='res.users', res_ids=[1, 2])
+        self.assertEqual(job.job_id_cups, 42)
+        self.assertEqual(job.printer_id, printer)
+        self.assertEqual(job.res_model, 'res.users')
+        self.assertEqual(job.res_ids, '1,2')
+        self.assertEqual(job.user_id, self.env.user)
+        cups.Connection().createJob.assert_called_once_with(
+            printer.system_name, 'report_name', {})
+        cups.Connection().startDocument.assert_called_once_with(
+            printer.system_name, 42, 'report_name',
+            'application/octet-stream', 1)
+        cups.Connection().writeRequestData.assert_called_once_with(
+            'content to print', 16)
+        cups.Connection().finishDocument.assert_called_once_with(
+            printer.system_name)
+
+    def test_create_job_existing(self):
+        """ It should only link a job already read from CUPS """
+        printer = self.new_record()
+        job = self.env['printing.job'].create({
+            'printer_id': printer.id,
+            'job_id_cups': 42,
+            'job_state': 'completed',
+            'job_media_progress': 100,
+            'time_at_creation': '2017-01-01 00:00:00',
+        })
+        self.assertEqual(
+            printer._create_job(42, 'Title', res_model='res.users',
+                                res_ids=1),
+            job)
+        self.assertEqual(job.job_state, 'completed')
+        self.assertEqual(job.res_ids, '1')
+        self.assertEqual(job.user_id, self.env.user)
+        # Nothing to write anymore
+        self.assertEqual(printer._create_job(
+            42, 'Title', res_model='res.users', res_ids=1), job)
+
+    @mock.patch('%s.cups' % server_model)
+    def test_print_report_wait(self, cups):
+        """ It should read the job until it is finished """
+        cups.Connection().createJob.return_value = 42
+        job_data = {
+            'printer-uri': 'ipp://localhost/printers/Sys Name',
+            'time-at-creation': 1000,
+        }
+        cups.Connection().getJobAttributes.side_effect = [
+            dict(job_data, **{'job-state': 5}),
+            dict(job_data, **{'job-state': 9}),
+        ]
+        printer = self.new_record()
+        with mock.patch('%s.JOB_WAIT_BACKOFF' % server_model, 0):
+            job = printer.print_document(
+                'report_name', 'content to print', 'pdf', wait=10)
+        self.assertEqual(job.job_state, 'completed')
+        self.assertEqual(cups.Connection().getJobAttributes.call_count, 2)
+        cups.Connection().getJobAttributes.assert_called_with(
+            42, requested_attributes=mock.ANY)
+        cups.Connection().getJobs.assert_not_called()
+
+    @mock.patch('%s.cups' % server_model)
+    def test_print_report_wait_timeout(self, cups):
+        """ It should give up waiting for the job after the timeout """
+        cups.Connection().createJob.return_value = 42
+        cups.Connection().getJobAttributes.return_value = {
+            'printer-uri': 'ipp://localhost/printers/Sys Name',
+            'time-at-creation': 1000,
+            'job-state': 4,
+        }
+        printer = self.new_record()
+        job = printer.print_document(
+            'report_name', 'content to print', 'pdf', wait=0.01)
+        self.assertEqual(job.job_state, 'pending held')
+
+    @mock.patch('%s.cups' % server_model)
+    def test_print_report_chunks(self, cups):
+        """ It should send file objects and iterators by chunks """
+        cups.Connection().createJob.side_effect = [1, 2]
+        printer = self.new_record()
+        with mock.patch('%s.PRINT_CHUNK_SIZE' % model, 4):
+            printer.print_document(None, io.BytesIO(b'0123456789'), 'raw')
+        cups.Connection().writeRequestData.assert_has_calls([
+            mock.call(b'0123', 4),
+            mock.call(b'4567', 4),
+            mock.call(b'89', 2),
+        ])
+        cups.Connection().startDocument.assert_called_once_with(
+            printer.system_name, mock.ANY, printer.name,
+            'application/vnd.cups-raw', 1)
+        cups.Connection().writeRequestData.reset_mock()
+        printer.print_document(None, iter([b'01', b'', b'23']), 'raw')
+        cups.Connection().writeRequestData.assert_has_calls([
+            mock.call(b'01', 2),
+            mock.call(b'23', 2),
+        ])
+
+    @mock.patch('%s.cups' % server_model)
+    def test_print_report_cancel(self, cups):
+        """ It should cancel the job when the document cannot be sent """
+        cups.Connection().createJob.return_value = 42
+        cups.Connection().writeRequestData.side_effect = IOError
+        printer = self.new_record()
+        with self.assertRaises(IOError):
             printer.print_document('report_name', 'content to print', 'pdf')
-            cups.Connection().printFile.assert_called_once_with(
-                printer.system_name,
-                file_name,
-                file_name,
-                options={})
+        cups.Connection().cancelJob.assert_called_once_with(
+            42, purge_job=False)
 
     @mock.patch('%s.cups' % server_model)
     def test_print_report_error(self, cups):
         """ It should print a report through CUPS """
         cups.Connection.side_effect = Exception
-        fd, file_name = tempfile.mkstemp()
-        with mock.patch('%s.mkstemp' % model) as mkstemp:
-            mkstemp.return_value = fd, file_name
-            printer = self.new_record()
-            with self.assertRaises(UserError):
-                printer.print_document(
-                    'report_name', 'content to print', 'pdf')
+        printer = self.new_record()
+        with self.assertRaises(UserError):
+            printer.print_document(
+                'report_name', 'content to print', 'pdf')
+
+    @mock.patch('%s.cups' % server_model)
+    def test_print_attachment(self, cups):
+        """ It should print the file of an attachment """
+        attachment = self.env['ir.attachment'].create({
+            'name': 'Document',
+            'datas': base64.b64encode(b'content to print'),
+        })
+        cups.Connection().createJob.return_value = 42
+        printer = self.new_record()
+        job = printer.print_attachment(attachment, copies=2)
+        self.assertEqual(job.res_ids, str(attachment.id))
+        cups.Connection().createJob.assert_called_once_with(
+            printer.system_name, 'Document', {'copies': '2'})
+        cups.Connection().writeRequestData.assert_called_once_with(
+            b'content to print', 16)
+
+    def test_print_attachment_url(self):
+        """ It should refuse to print attachments without file """
+        attachment = self.env['ir.attachment'].create({
+            'name': 'Link',
+            'type': 'url',
+            'url': 'http://example.com',
+        })
+        with self.assertRaises(UserError):
+            self.new_record().print_attachment(attachment)
 
     @mock.patch('%s.cups' % server_model)
     def test_print_file(self, cups):
         """ It should print a file through CUPS """
+        cups.Connection().printFile.return_value = 42
         file_name = 'file_name'
         printer = self.new_record()
-        printer.print_file(file_name, 'pdf')
+        job = printer.print_file(file_name, 'pdf')
+        self.assertEqual(job.job_id_cups, 42)
         cups.Connection().printFile.assert_called_once_with(
             printer.system_name,
             file_name,
@@ -95,6 +234,42 @@ class TestPrintingPrinter(TransactionCase):
         with self.assertRaises(UserError):
             printer.print_file(file_name)
 
+    def test_changed_values(self):
+        """ It should only keep values which differ from the record """
+        printer = self.new_record()
+        self.assertEqual(changed_values(printer, {
+            'name': printer.name,
+            'server_id': self.server.id,
+            'status': 'available',
+            'status_message': printer.status_message,
+        }), {'status': 'available'})
+        printer.status_message = False
+        self.assertEqual(changed_values(printer, {
+            'status_message': '',
+            'job_ids': [],
+        }), {})
+
+    def test_failover_printer(self):
+        """ It should follow the failover chain up to a working printer """
+        printer = self.new_record()
+        backup = self.new_record()
+        last_resort = self.new_record()
+        printer.failover_printer_id = backup
+        backup.failover_printer_id = last_resort
+        self.assertEqual(printer._get_available_printer(), printer)
+        (printer | backup).write({'status': 'error'})
+        self.assertEqual(printer._get_available_printer(), last_resort)
+        last_resort.status = 'server-error'
+        self.assertEqual(printer._get_available_printer(), printer)
+
+    def test_failover_printer_loop(self):
+        """ It should refuse failover chains forming a loop """
+        printer = self.new_record()
+        backup = self.new_record()
+        printer.failover_printer_id = backup
+        with self.assertRaises(ValidationError):
+            backup.failover_printer_id = printer
+
     def test_set_default(self):
         """ It should set a single record as default """
         printer = self.new_record()
@@ -110,6 +285,7 @@ class TestPrintingPrinter(TransactionCase):
     @mock.patch('%s.cups' % server_model)
     def test_cancel_all_jobs(self, cups):
         """ It should cancel all jobs """
+        self.set_printer_status(cups)
         printer = self.new_record()
         printer.action_cancel_all_jobs()
         cups.Connection().cancelAllJobs.assert_called_once_with(
@@ -120,6 +296,7 @@ class TestPrintingPrinter(TransactionCase):
     @mock.patch('%s.cups' % server_model)
     def test_cancel_and_purge_all_jobs(self, cups):
         """ It should cancel all jobs """
+        self.set_printer_status(cups)
         printer = self.new_record()
         printer.cancel_all_jobs(purge_jobs=True)
         cups.Connection().cancelAllJobs.assert_called_once_with(
@@ -127,18 +304,86 @@ class TestPrintingPrinter(TransactionCase):
             purge_jobs=True,
         )
 
+    @mock.patch('%s.cups' % server_model)
+    def test_cancel_all_jobs_refresh(self, cups):
+        """ It should only read again the unfinished jobs of the printer """
+        self.set_printer_status(cups)
+        printer = self.new_record()
+        job_obj = self.env['printing.job']
+        jobs = job_obj
+        for job_id_cups, job_state in ((1, 'completed'), (2, 'pending'),
+                                       (3, 'processing'), (4, 'pending')):
+            jobs |= job_obj.create({
+                'printer_id': printer.id,
+                'job_id_cups': job_id_cups,
+                'job_state': job_state,
+                'job_media_progress': 0,
+                'time_at_creation': '2017-01-01 00:00:00',
+            })
+        cups.IPPError = IPPError
+        cups.IPP_NOT_FOUND = 0x0406
+        cups.Connection().getJobAttributes.side_effect = [{
+            'printer-uri': 'ipp://localhost/printers/Sys Name',
+            'time-at-creation': 1000,
+            'job-state': 7,
+        }, IPPError(0x0406, 'Not found'), IPPError(0x0500, 'Internal error')]
+        printer.cancel_all_jobs()
+        cups.Connection().getJobAttributes.assert_has_calls([
+            mock.call(2, requested_attributes=mock.ANY),
+            mock.call(3, requested_attributes=mock.ANY),
+            mock.call(4, requested_attributes=mock.ANY),
+        ])
+        cups.Connection().getJobs.assert_not_called()
+        self.assertEqual(
+            jobs.mapped('job_state'),
+            ['completed', 'canceled', 'canceled', 'pending'])
+        self.assertEqual(jobs.mapped('active'), [True, True, False, True])
+
     @mock.patch('%s.cups' % server_model)
     def test_enable_printer(self, cups):
         """ It should enable the printer """
+        self.set_printer_status(cups)
         printer = self.new_record()
         printer.enable()
         cups.Connection().enablePrinter.assert_called_once_with(
             printer.system_name)
+        self.assertEqual(printer.status, 'available')
 
     @mock.patch('%s.cups' % server_model)
     def test_disable_printer(self, cups):
         """ It should disable the printer """
+        self.set_printer_status(cups, state=5)
         printer = self.new_record()
         printer.disable()
         cups.Connection().disablePrinter.assert_called_once_with(
             printer.system_name)
+        self.assertEqual(printer.status, 'error')
+
+    @mock.patch('%s.cups' % server_model)
+    def test_disable_printers(self, cups):
+        """ It should use one connection per server, and no full update """
+        self.set_printer_status(cups, state=5)
+        other_server = self.ServerModel.create({'address': 'other'})
+        printers = self.Model
+        for server in (self.server, other_server):
+            for system_name in ('First', 'Second'):
+                printers |= self.Model.create(dict(
+                    self.printer_vals,
+                    server_id=server.id,
+                    system_name=system_name,
+                ))
+        cups.Connection.reset_mock()
+        printers.disable()
+        self.assertEqual(cups.Connection.call_count, 2)
+        self.assertEqual(cups.Connection().disablePrinter.call_count, 4)
+        self.assertEqual(
+            cups.Connection().getPrinterAttributes.call_count, 4)
+        cups.Connection().getPrinters.assert_not_called()
+
+    @mock.patch('%s.cups' % server_model)
+    def test_disable_printer_error(self, cups):
+        """ It should report the servers which could not be reached """
+        cups.Connection.side_effect = Exception
+        printer = self.new_record()
+        with self.assertRaises(UserError):
+            printer.disable()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo import fields
+from odoo.tests.common import TransactionCase
+
+
+class TestPrintingPrinterPool(TransactionCase):
+
+    def setUp(self):
+        super(TestPrintingPrinterPool, self).setUp()
+        self.server = self.env['printing.server'].create({})
+        self.printers = self.env['printing.printer']
+        for system_name in ('First', 'Second', 'Third'):
+            self.printers |= self.env['printing.printer'].create({
+                'name': system_name,
+                'server_id': self.server.id,
+                'system_name': system_name,
+                'status': 'available',
+            })
+        self.pool = self.env['printing.printer.pool'].create({
+            'name': 'Pool',
+            'printer_ids': [(6, 0, self.printers.ids)],
+        })
+
+    def new_jobs(self, printer, count, job_state='pending'):
+        for index in range(count):
+            self.env['printing.job'].create({
+                'printer_id': printer.id,
+                'job_id_cups': printer.id * 100 + index,
+                'job_state': job_state,
+                'job_media_progress': 0,
+                'time_at_creation': fields.Datetime.now(),
+            })
+
+    def test_select_least_loaded(self):
+        """ It should select the printer with the fewest pending jobs """
+        first, second, third = self.printers
+        self.new_jobs(first, 2)
+        self.new_jobs(second, 1)
+        self.new_jobs(third, 3)
+        self.new_jobs(second, 5, job_state='completed')
+        self.assertEqual(self.pool.select_printer(), second)
+
+    def test_select_spooled(self):
+        """ It should count the documents waiting in the print spool """
+        first, second, third = self.printers
+        self.new_jobs(first, 1)
+        self.new_jobs(third, 1)
+        for index in range(2):
+            self.env['printing.spool'].create({
+                'name': 'Document',
+                'printer_id': second.id,
+            })
+        self.env['printing.spool'].create({
+            'name': 'Sent',
+            'printer_id': first.id,
+            'state': 'done',
+        })
+        self.assertEqual(self.pool.select_printer(), first)
+
+    def test_select_available(self):
+        """ It should skip the printers which cannot print """
+        first, second, third = self.printers
+        self.new_jobs(first, 1)
+        self.new_jobs(third, 1)
+        second.status = 'error'
+        self.assertEqual(self.pool.select_printer(), first)
+
+    def test_select_unavailable(self):
+        """ It should fall back to the first printer when none can print """
+        self.printers.write({'status': 'server-error'})
+        self.assertEqual(self.pool.select_printer(), self.printers[0])
@@ -5,6 +5,7 @@
 import mock
 
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
 from odoo.exceptions import UserError
 
 
@@ -19,6 +20,8 @@ class TestPrintingPrinterWizard(TransactionCase):
 
     def setUp(self):
         super(TestPrintingPrinterWizard, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['printing.printer.update.wizard']
         self.server = self.env['printing.server'].create({})
         self.printer_vals = {
@@ -2,19 +2,35 @@
 # Copyright 2016 LasLabs Inc.
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
+from datetime import timedelta
+
 import mock
 
-from odoo import fields
+from odoo import exceptions, fields
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import (
+    BREAKER_THRESHOLD,
+    OperationTimeout,
+    clear_pools,
+)
+from odoo.addons.base_report_to_printer.models.printing_server import (
+    JOBS_PAGE_SIZE,
+)
 
 
 model = 'odoo.addons.base_report_to_printer.models.printing_server'
 
 
+class IPPError(Exception):
+    pass
+
+
 class TestPrintingServer(TransactionCase):
 
     def setUp(self):
         super(TestPrintingServer, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['printing.server']
         self.server = self.Model.create({})
         self.printer_vals = {
@@ -55,6 +71,30 @@ class TestPrintingServer(TransactionCase):
             'server-error', rec_id.status,
         )
 
+    @mock.patch('%s.cups' % model)
+    def test_open_connection_fails_fast(self, cups):
+        """ It should stop contacting a server failing repeatedly """
+        cups.Connection.side_effect = Exception
+        for attempt in range(BREAKER_THRESHOLD):
+            self.assertFalse(self.server._open_connection())
+        cups.Connection.reset_mock()
+        rec_id = self.new_printer()
+        self.Model.update_printers()
+        self.assertEqual('server-error', rec_id.status)
+        with self.assertRaises(exceptions.UserError):
+            self.server._open_connection(raise_on_error=True)
+        cups.Connection.assert_not_called()
+
+    @mock.patch('%s.cups' % model)
+    def test_update_printers_call_error(self, cups):
+        """ It should set printers in error when printers cannot be listed """
+        cups.Connection().getPrinters.side_effect = OperationTimeout
+        rec_id = self.new_printer()
+        self.Model.update_printers()
+        self.assertEqual('server-error', rec_id.status)
+        with self.assertRaises(exceptions.UserError):
+            self.Model.update_printers(raise_on_error=True)
+
     @mock.patch('%s.cups' % model)
     def test_update_printers_inits_cups(self, cups):
         """ It should init CUPS connection """
@@ -64,6 +104,52 @@ class TestPrintingServer(TransactionCase):
             host=self.server.address, port=self.server.port,
         )
 
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_reuses_connection(self, cups):
+        """ It should connect only once to update printers and jobs """
+        self.new_printer()
+        self.server.action_update_jobs()
+        cups.Connection.assert_called_once_with(
+            host=self.server.address, port=self.server.port,
+        )
+
+    @mock.patch('%s.cups' % model)
+    def test_update_printers_all_servers(self, cups):
+        """ It should refresh the printers of all servers """
+        other_server = self.Model.create({'port': 632})
+        self.new_printer()
+        self.printer_vals['server_id'] = other_server.id
+        other_printer = self.new_printer()
+
+        def connect(host, port):
+            if port == other_server.port:
+                raise Exception()
+            return mock.MagicMock()
+        cups.Connection.side_effect = connect
+        self.Model.update_printers()
+        self.assertEqual('server-error', other_printer.status)
+        self.assertEqual(2, cups.Connection.call_count)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_printers_skips_unchanged(self, cups):
+        """ It should only write printers which changed """
+        rec_id = self.new_printer()
+        cups.Connection().getPrinters.return_value = {
+            rec_id.system_name: {
+                'printer-info': rec_id.name,
+                'printer-make-and-model': rec_id.model,
+                'printer-location': rec_id.location,
+                'device-uri': rec_id.uri,
+                'printer-state': 3,
+                'printer-state-message': rec_id.status_message,
+            },
+        }
+        self.Model.update_printers()
+        self.assertEqual('available', rec_id.status)
+        with mock.patch.object(type(rec_id), 'write') as write:
+            self.Model.update_printers()
+            write.assert_not_called()
+
     @mock.patch('%s.cups' % model)
     def test_update_printers_gets_all_printers(self, cups):
         """ It should get all printers from CUPS server """
@@ -105,6 +191,7 @@ class TestPrintingServer(TransactionCase):
         cups.Connection().getJobs.assert_called_once_with(
             which_jobs='all',
             first_job_id=-1,
+            limit=JOBS_PAGE_SIZE,
             requested_attributes=[
                 'job-name',
                 'job-id',
@@ -115,6 +202,7 @@ class TestPrintingServer(TransactionCase):
                 'job-state-reasons',
                 'time-at-processing',
                 'time-at-completed',
+                'job-impressions-completed',
             ],
         )
 
@@ -127,6 +215,7 @@ class TestPrintingServer(TransactionCase):
         cups.Connection().getJobs.assert_called_once_with(
             which_jobs='all',
             first_job_id=-1,
+            limit=JOBS_PAGE_SIZE,
             requested_attributes=[
                 'job-name',
                 'job-id',
@@ -137,6 +226,7 @@ class TestPrintingServer(TransactionCase):
                 'job-state-reasons',
                 'time-at-processing',
                 'time-at-completed',
+                'job-impressions-completed',
             ],
         )
 
@@ -163,7 +253,7 @@ class TestPrintingServer(TransactionCase):
         })
         self.server.update_jobs(which='not-completed')
         cups.Connection().getJobs.assert_any_call(
-            which_jobs='completed', first_job_id=2,
+            which_jobs='all', first_job_id=2, limit=JOBS_PAGE_SIZE,
             requested_attributes=[
                 'job-name',
                 'job-id',
@@ -174,6 +264,7 @@ class TestPrintingServer(TransactionCase):
                 'job-state-reasons',
                 'time-at-processing',
                 'time-at-completed',
+                'job-impressions-completed',
             ],
         )
 
@@ -211,3 +302,343 @@ class TestPrintingServer(TransactionCase):
         self.assertEqual(completed_job.job_state, 'completed')
         self.assertEqual(purged_job.active, False)
         self.assertEqual(new_job.job_state, 'processing')
+
+    @mock.patch('%s.cups' % model)
+    def test_update_from_notifications_subscribe(self, cups):
+        """ It should subscribe to notifications and update everything """
+        self.new_printer()
+        self.server.sync_mode = 'subscription'
+        cups.Connection().createSubscription.return_value = 42
+        self.Model.action_update_jobs()
+        cups.Connection().createSubscription.assert_called_once_with(
+            'ipp://localhost:631/', events=mock.ANY, lease_duration=mock.ANY)
+        cups.Connection().getPrinters.assert_called_once_with()
+        self.assertTrue(cups.Connection().getJobs.called)
+        self.assertEqual(self.server.subscription_id, 42)
+        self.assertEqual(self.server.subscription_sequence, 0)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_from_notifications_events(self, cups):
+        """ It should only update what the events mention """
+        printer = self.new_printer()
+        self.server.write({
+            'sync_mode': 'subscription',
+            'subscription_id': 42,
+            'subscription_sequence': 3,
+            'subscription_date': fields.Datetime.now(),
+        })
+        cups.Connection().getNotifications.return_value = {'events': [{
+            'notify-sequence-number': 5,
+            'notify-subscribed-event': 'job-completed',
+            'notify-job-id': 7,
+            'printer-name': printer.system_name,
+        }, {
+            'notify-sequence-number': 4,
+            'notify-subscribed-event': 'printer-state-changed',
+            'printer-name': printer.system_name,
+            'printer-state': 5,
+        }]}
+        cups.Connection().getJobAttributes.return_value = {
+            'job-printer-uri': 'hostname:port/' + printer.system_name,
+            'job-state': 9,
+        }
+        self.server.update_from_notifications()
+        cups.Connection().getNotifications.assert_called_once_with(
+            [42], sequence_numbers=[4])
+        cups.Connection().getPrinters.assert_not_called()
+        cups.Connection().getJobs.assert_not_called()
+        cups.Connection().renewSubscription.assert_not_called()
+        self.assertEqual(printer.status, 'error')
+        job = self.env['printing.job'].search([('job_id_cups', '=', 7)])
+        self.assertEqual(job.job_state, 'completed')
+        self.assertEqual(self.server.subscription_sequence, 5)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_from_notifications_lost_events(self, cups):
+        """ It should update everything when events have been lost """
+        self.new_printer()
+        self.server.write({
+            'sync_mode': 'subscription',
+            'subscription_id': 42,
+            'subscription_sequence': 3,
+            'subscription_date': fields.Datetime.now(),
+        })
+        cups.Connection().getNotifications.return_value = {'events': [{
+            'notify-sequence-number': 10,
+            'notify-subscribed-event': 'job-created',
+        }]}
+        self.server.update_from_notifications()
+        cups.Connection().getPrinters.assert_called_once_with()
+        self.assertTrue(cups.Connection().getJobs.called)
+        self.assertEqual(self.server.subscription_sequence, 10)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_from_notifications_expired(self, cups):
+        """ It should subscribe again only when CUPS lost the subscription """
+        self.new_printer()
+        self.server.write({
+            'sync_mode': 'subscription',
+            'subscription_id': 42,
+            'subscription_sequence': 3,
+            'subscription_date': fields.Datetime.now(),
+        })
+        cups.IPPError = IPPError
+        cups.IPP_NOT_FOUND = 0x0406
+        cups.Connection().createSubscription.return_value = 43
+
+        cups.Connection().getNotifications.side_effect = IPPError(
+            0x0500, 'Internal error')
+        self.server.update_from_notifications()
+        cups.Connection().createSubscription.assert_not_called()
+        self.assertEqual(self.server.subscription_id, 42)
+
+        cups.Connection().getNotifications.side_effect = IPPError(
+            0x0406, 'Not found')
+        self.server.update_from_notifications()
+        cups.Connection().createSubscription.assert_called_once_with(
+            'ipp://localhost:631/', events=mock.ANY, lease_duration=mock.ANY)
+        self.assertEqual(self.server.subscription_id, 43)
+
+    @mock.patch('%s.cups' % model)
+    def test_cancel_subscription(self, cups):
+        """ It should cancel the subscription when going back to polling """
+        self.server.write({
+            'sync_mode': 'subscription',
+            'subscription_id': 42,
+        })
+        self.server.sync_mode = 'poll'
+        cups.Connection().cancelSubscription.assert_called_once_with(42)
+        self.assertFalse(self.server.subscription_id)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_other_server(self, cups):
+        """ It should only update the jobs of the updated server """
+        printer = self.new_printer()
+        other_server = self.Model.create({'port': 632})
+        self.printer_vals['server_id'] = other_server.id
+        other_printer = self.new_printer()
+        job = self.new_job(printer, vals={'job_state': 'processing'})
+        other_job = self.new_job(other_printer, vals={
+            'job_state': 'processing',
+            'server_id': other_server.id,
+        })
+        cups.Connection().getJobs.return_value = {
+            1: {
+                'printer-uri': 'hostname:port/' + printer.system_name,
+                'job-state': 9,
+                'job-state-reasons': ['job-completed-successfully'],
+            },
+        }
+        self.server.update_jobs(which='not-completed')
+        self.assertEqual(job.job_state, 'completed')
+        self.assertEqual(job.job_state_reason, 'job-completed-successfully')
+        self.assertEqual(other_job.job_state, 'processing')
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_full_sync(self, cups):
+        """ It should record the high-water mark of a full update """
+        printer = self.new_printer()
+        cups.Connection().getJobs.return_value = {
+            5: {'printer-uri': 'hostname:port/' + printer.system_name},
+        }
+        self.server.write({'last_job_id_cups': 100})
+        self.Model.action_update_jobs()
+        self.assertEqual(self.server.last_job_id_cups, 5)
+        self.assertTrue(self.server.job_full_sync_date)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_incremental(self, cups):
+        """ It should only get the new and the open jobs """
+        printer = self.new_printer()
+        printer_uri = 'hostname:port/' + printer.system_name
+        self.server.write({
+            'last_job_id_cups': 3,
+            'job_full_sync_date': fields.Datetime.now(),
+        })
+        self.new_job(printer, vals={'job_state': 'completed'})
+        open_job = self.new_job(printer, vals={
+            'job_id_cups': 2,
+            'job_state': 'processing',
+        })
+
+        def get_jobs(which_jobs, first_job_id=-1, limit=-1,
+                     requested_attributes=None):
+            if which_jobs == 'all':
+                return {4: {'printer-uri': printer_uri, 'job-state': 3}}
+            return {}
+
+        cups.Connection().getJobs.side_effect = get_jobs
+        cups.Connection().getJobAttributes.return_value = {
+            'job-printer-uri': printer_uri,
+            'job-state': 9,
+        }
+        self.Model.action_update_jobs()
+        cups.Connection().getJobs.assert_any_call(
+            which_jobs='all', first_job_id=4, limit=JOBS_PAGE_SIZE,
+            requested_attributes=mock.ANY)
+        cups.Connection().getJobAttributes.assert_called_once_with(
+            2, requested_attributes=mock.ANY)
+        new_job = self.env['printing.job'].search([('job_id_cups', '=', 4)])
+        self.assertEqual(new_job.job_state, 'pending')
+        self.assertEqual(open_job.job_state, 'completed')
+        self.assertEqual(self.server.last_job_id_cups, 4)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_incremental_no_job(self, cups):
+        """ It should do nothing when the server has no new or open job """
+        self.server.write({
+            'last_job_id_cups': 3,
+            'job_full_sync_date': fields.Datetime.now(),
+        })
+        cups.Connection().getJobs.return_value = {}
+        self.assertTrue(self.server.update_jobs_incremental())
+        self.assertEqual(cups.Connection().getJobs.call_count, 2)
+        self.assertEqual(self.server.last_job_id_cups, 3)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_purge_other_server(self, cups):
+        """ It should only deactivate the purged jobs of the server """
+        printer = self.new_printer()
+        other_server = self.Model.create({'port': 632})
+        self.printer_vals['server_id'] = other_server.id
+        other_printer = self.new_printer()
+        purged_job = self.new_job(printer, vals={'job_id_cups': 2})
+        other_job = self.new_job(other_printer, vals={
+            'job_id_cups': 3,
+            'server_id': other_server.id,
+        })
+        cups.Connection().getJobs.return_value = {}
+        self.server.update_jobs()
+        self.assertFalse(purged_job.active)
+        self.assertTrue(other_job.active)
+
+    def test_purge_jobs_days(self):
+        """ It should delete the finished jobs older than the retention """
+        printer = self.new_printer()
+        old_date = fields.Datetime.to_string(
+            fields.Datetime.from_string(fields.Datetime.now()) -
+            timedelta(days=10))
+        old_job = self.new_job(printer, vals={
+            'job_state': 'completed',
+            'time_at_creation': old_date,
+        })
+        old_pending_job = self.new_job(printer, vals={
+            'job_id_cups': 2,
+            'job_state': 'pending',
+        })
+        recent_job = self.new_job(printer, vals={
+            'job_id_cups': 3,
+            'job_state': 'completed',
+            'time_at_creation': fields.Datetime.now(),
+        })
+        self.server.job_retention_days = 5
+        self.Model._cron_purge_jobs()
+        self.assertFalse(old_job.exists())
+        self.assertTrue(old_pending_job.exists())
+        self.assertTrue(recent_job.exists())
+        self.assertEqual(self.server.purged_job_id_cups, 1)
+
+    def test_purge_jobs_count(self):
+        """ It should only keep the most recent jobs of each printer """
+        printer = self.new_printer()
+        jobs = self.env['printing.job']
+        for job_id in range(1, 5):
+            jobs |= self.new_job(printer, vals={
+                'job_id_cups': job_id,
+                'job_state': 'completed',
+            })
+        self.server.job_retention_count = 2
+        self.server._purge_jobs(chunk_size=1)
+        self.assertEqual(
+            sorted(jobs.exists().mapped('job_id_cups')), [3, 4])
+        self.assertEqual(self.server.purged_job_id_cups, 2)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_skips_deleted(self, cups):
+        """ It should not synchronize again the deleted finished jobs """
+        printer = self.new_printer()
+        printer_uri = 'hostname:port/' + printer.system_name
+        self.server.purged_job_id_cups = 2
+        cups.Connection().getJobs.return_value = {
+            1: {'printer-uri': printer_uri, 'job-state': 9},
+            2: {'printer-uri': printer_uri, 'job-state': 5},
+            3: {'printer-uri': printer_uri, 'job-state': 9},
+        }
+        self.server.update_jobs()
+        jobs = self.env['printing.job'].search([
+            ('server_id', '=', self.server.id),
+        ])
+        self.assertEqual(jobs.mapped('job_id_cups'), [3, 2])
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_pages(self, cups):
+        """ It should read the jobs by pages, writing each one in turn """
+        printer = self.new_printer()
+        printer_uri = 'hostname:port/' + printer.system_name
+
+        def get_jobs(which_jobs, first_job_id=-1, limit=-1,
+                     requested_attributes=None):
+            first_job_id = max(first_job_id, 1)
+            return dict(
+                (job_id, {'printer-uri': printer_uri})
+                for job_id in range(first_job_id, min(
+                    first_job_id + limit, JOBS_PAGE_SIZE + 11)))
+
+        cups.Connection().getJobs.side_effect = get_jobs
+        self.server.update_jobs()
+        self.assertEqual(cups.Connection().getJobs.call_count, 2)
+        cups.Connection().getJobs.assert_called_with(
+            which_jobs='all', first_job_id=JOBS_PAGE_SIZE + 1,
+            limit=JOBS_PAGE_SIZE, requested_attributes=mock.ANY)
+        self.assertEqual(len(printer.job_ids), JOBS_PAGE_SIZE + 10)
+        self.assertEqual(self.server.last_job_id_cups, JOBS_PAGE_SIZE + 10)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_due(self, cups):
+        """ It should only run the updates whose interval elapsed """
+        printer = self.new_printer()
+        cups.Connection().getPrinters.return_value = {
+            printer.system_name: {'printer-state': 5},
+        }
+        now = fields.Datetime.now()
+        self.server.write({
+            'printer_update_date': now,
+            'job_update_date': now,
+            'job_full_sync_date': now,
+        })
+        self.Model.action_update_jobs()
+        cups.Connection().getPrinters.assert_called_once_with()
+        cups.Connection().getPPD3.assert_not_called()
+        cups.Connection().getJobs.assert_not_called()
+        self.assertEqual(printer.status, 'error')
+        self.assertNotEqual(self.server.status_update_date, False)
+
+    @mock.patch('%s.cups' % model)
+    def test_update_printers_status_new_printer(self, cups):
+        """ It should fully update printers when new ones appear """
+        cups.Connection().getPrinters.return_value = {
+            'New Printer': {
+                'printer-info': 'Info',
+                'printer-make-and-model': 'Make and model',
+                'device-uri': 'usb://printer',
+            },
+        }
+        self.server.update_printers(status_only=True)
+        self.assertEqual(
+            self.server.printer_ids.mapped('system_name'), ['New Printer'])
+
+    @mock.patch('%s.cups' % model)
+    def test_update_jobs_unknown_printer(self, cups):
+        """ It should link jobs to new printers without reading CUPS printers
+        """
+        self.server.printer_update_date = fields.Datetime.now()
+        cups.Connection().getJobs.return_value = {
+            1: {'printer-uri': 'hostname:port/New Printer'},
+        }
+        self.server.update_jobs()
+        cups.Connection().getPrinters.assert_not_called()
+        self.assertEqual(
+            self.server.printer_ids.mapped('system_name'), ['New Printer'])
+        self.assertEqual(
+            self.server.printer_ids.mapped('job_ids.job_id_cups'), [1])
+        self.assertFalse(self.server.printer_update_date)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import mock
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
+from odoo.addons.base_report_to_printer.models.printing_spool import (
+    SPOOL_MAX_ATTEMPTS,
+)
+
+
+model = 'odoo.addons.base_report_to_printer.models.printing_server'
+
+
+class TestPrintingSpool(TransactionCase):
+
+    def setUp(self):
+        super(TestPrintingSpool, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
+        self.Model = self.env['printing.spool']
+        self.server = self.env['printing.server'].create({})
+        self.printer = self.env['printing.printer'].create({
+            'name': 'Printer',
+            'server_id': self.server.id,
+            'system_name': 'Sys Name',
+            'default': True,
+            'status': 'unknown',
+            'status_message': 'Msg',
+            'model': 'res.users',
+            'location': 'Location',
+            'uri': 'URI',
+            'spool': True,
+        })
+
+    def new_entry(self):
+        return self.Model.enqueue(
+            self.printer, 'report_name', b'content to print', 'pdf')
+
+    @mock.patch('%s.cups' % model)
+    def test_enqueue(self, cups):
+        """ It should record the document without contacting CUPS """
+        entry = self.new_entry()
+        cups.Connection.assert_not_called()
+        self.assertEqual(entry.name, 'report_name')
+        self.assertEqual(entry.state, 'pending')
+
+    @mock.patch('%s.cups' % model)
+    def test_process_spool(self, cups):
+        """ It should send the pending documents and link their job """
+        cups.Connection().createJob.return_value = 42
+        entry = self.new_entry()
+        self.Model._cron_process_spool()
+        cups.Connection().writeRequestData.assert_called_once_with(
+            b'content to print', 16)
+        self.assertEqual(entry.state, 'done')
+        self.assertFalse(entry.document)
+        self.assertEqual(entry.job_id.job_id_cups, 42)
+        self.assertEqual(entry.job_id.printer_id, self.printer)
+
+    @mock.patch('%s.cups' % model)
+    def test_process_spool_job_error(self, cups):
+        """ It should not send again a document whose job is not recorded """
+        cups.Connection().createJob.return_value = 42
+        entry = self.new_entry()
+        with mock.patch('odoo.addons.base_report_to_printer.models.'
+                        'printing_printer.PrintingPrinter._create_job',
+                        side_effect=Exception):
+            self.Model._cron_process_spool()
+        self.assertEqual(entry.state, 'done')
+        self.assertFalse(entry.job_id)
+
+    @mock.patch('%s.cups' % model)
+    def test_process_spool_error(self, cups):
+        """ It should try again later, then give up """
+        cups.Connection.side_effect = Exception
+        entry = self.new_entry()
+        self.Model._cron_process_spool()
+        self.assertEqual(entry.state, 'pending')
+        self.assertEqual(entry.attempt_count, 1)
+        self.assertGreater(entry.next_attempt_date, entry.create_date)
+        self.assertTrue(entry.error)
+
+        # Not due yet
+        self.Model._cron_process_spool()
+        self.assertEqual(entry.attempt_count, 1)
+
+        entry.attempt_count = SPOOL_MAX_ATTEMPTS - 1
+        entry._send()
+        self.assertEqual(entry.state, 'failed')
+        entry.action_retry()
+        self.assertEqual(entry.state, 'pending')
+        self.assertEqual(entry.attempt_count, 0)
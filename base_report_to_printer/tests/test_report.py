@@ -87,7 +87,7 @@ class TestReport(HttpCase):
             document = self.env['report'].get_pdf(
                 records.ids, report.report_name)
             print_document.assert_called_once_with(
-                report, document, report.report_type)
+                report, document, report.report_type, res_ids=records.ids)
 
     def test_print_document_not_printable(self):
         """ It should print the report, regardless of the defined behaviour """
@@ -118,6 +118,29 @@ class TestReport(HttpCase):
             self.env['report'].print_document(records.ids, report.report_name)
             print_document.assert_called_once()
 
+    def test_print_document_spool(self):
+        """ It should queue the report for printers using a spool """
+        report = self.env['ir.actions.report.xml'].search([
+            ('report_type', '=', 'qweb-pdf'),
+        ], limit=1)
+        printer = self.new_printer()
+        printer.spool = True
+        report.printing_printer_id = printer
+        records = self.env[report.model].search([], limit=5)
+
+        with mock.patch('odoo.addons.base_report_to_printer.models.'
+                        'printing_printer.PrintingPrinter.'
+                        'print_document') as print_document:
+            self.env['report'].print_document(records.ids, report.report_name)
+            print_document.assert_not_called()
+        entry = self.env['printing.spool'].search([
+            ('printer_id', '=', printer.id),
+        ])
+        self.assertEqual(entry.report_id, report)
+        self.assertEqual(entry.res_model, report.model)
+        self.assertEqual(entry.res_ids, ','.join(map(str, records.ids)))
+        self.assertEqual(entry.state, 'pending')
+
     def test_print_document_no_printer(self):
         """ It should raise an error """
         report = self.env['ir.actions.report.xml'].search([
@@ -127,3 +150,52 @@ class TestReport(HttpCase):
 
         with self.assertRaises(exceptions.UserError):
             self.env['report'].print_document(records.ids, report.report_name)
+
+    def test_print_document_pool(self):
+        """ It should print on the least loaded printer of the pool """
+        report = self.env['ir.actions.report.xml'].search([
+            ('report_type', '=', 'qweb-pdf'),
+        ], limit=1)
+        busy_printer = self.new_printer()
+        printer = self.new_printer()
+        (busy_printer | printer).write({'spool': True})
+        self.env['printing.job'].create({
+            'printer_id': busy_printer.id,
+            'job_id_cups': 1,
+            'job_state': 'processing',
+            'job_media_progress': 0,
+            'time_at_creation': '2017-01-01 00:00:00',
+        })
+        report.printing_printer_pool_id = self.env[
+            'printing.printer.pool'].create({
+                'name': 'Pool',
+                'printer_ids': [(6, 0, (busy_printer | printer).ids)],
+            })
+        records = self.env[report.model].search([], limit=5)
+
+        self.env['report'].print_document(records.ids, report.report_name)
+        entry = self.env['printing.spool'].search([
+            ('report_id', '=', report.id),
+        ])
+        self.assertEqual(entry.printer_id, printer)
+
+    def test_print_document_failover(self):
+        """ It should print on the failover printer of a printer in error """
+        report = self.env['ir.actions.report.xml'].search([
+            ('report_type', '=', 'qweb-pdf'),
+        ], limit=1)
+        printer = self.new_printer()
+        backup = self.new_printer()
+        backup.spool = True
+        printer.write({
+            'status': 'unavailable',
+            'failover_printer_id': backup.id,
+        })
+        report.printing_printer_id = printer
+        records = self.env[report.model].search([], limit=5)
+
+        self.env['report'].print_document(records.ids, report.report_name)
+        entry = self.env['printing.spool'].search([
+            ('report_id', '=', report.id),
+        ])
+        self.assertEqual(entry.printer_id, backup)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import threading
+
+
+def changed_values(record, vals):
+    """ Return the items of `vals` which would modify `record`
+
+    Used to skip the no-op writes of values synchronized from CUPS.
+    Many2one values are compared by id, empty values are considered equal,
+    and non-empty x2many commands are always kept.
+    """
+    record.ensure_one()
+    changed = {}
+    for name, value in vals.items():
+        field = record._fields[name]
+        if field.type in ('one2many', 'many2many'):
+            if value:
+                changed[name] = value
+            continue
+
+        current = record[name]
+        if field.type == 'many2one':
+            current = current.id
+        if field.type not in ('integer', 'float', 'monetary', 'boolean'):
+            current, value = current or False, value or False
+        if current != value:
+            changed[name] = value
+    return changed
+
+
+def commit(env):
+    """ Commit the current transaction, unless running tests
+
+    Used by the long running jobs, to keep their transactions short. Only
+    the private methods run by the scheduler may call it, never a method
+    reachable over RPC.
+    """
+    if not getattr(threading.currentThread(), 'testing', False):
+        # Scheduled jobs commit their work by chunks, so that a failure
+        # does not roll back what was already done
+        env.cr.commit()  # pylint: disable=invalid-commit
@@ -2,7 +2,7 @@
 # Copyright (C) 2013-2014 Camptocamp (<http://www.camptocamp.com>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import api, fields, models
+from odoo import api, fields, models, tools
 
 
 class IrActionsReportXml(models.Model):
@@ -18,3 +18,34 @@ class IrActionsReportXml(models.Model):
     def onchange_printing_printer_id(self):
         """ Reset the tray when the printer is changed """
         self.printer_tray_id = False
+
+    @api.model
+    def _printing_behaviour_fields(self):
+        return super(IrActionsReportXml, self)._printing_behaviour_fields() | {
+            'printer_tray_id',
+        }
+
+    @api.model
+    @tools.ormcache('self._uid', 'self.env.user.company_id.id', 'report_id')
+    def _get_printer_tray_id(self, report_id):
+        """ Return the id of the tray to use for a report
+
+        Cached like the behaviours of the reports.
+        """
+        report = self.browse(report_id)
+        # Retrieve report default values
+        if report.printer_tray_id:
+            tray = report.printer_tray_id
+        else:
+            # Retrieve user default values
+            tray = self.env.user.printer_tray_id
+
+        # Retrieve report-user specific values
+        action = self.env['printing.report.xml.action'].search([
+            ('report_id', '=', report.id),
+            ('user_id', '=', self.env.uid),
+            ('action', '!=', 'user_default'),
+        ], limit=1)
+        if action.printer_tray_id:
+            tray = action.printer_tray_id
+        return tray.id
@@ -23,6 +23,16 @@ class PrintingPrinter(models.Model):
                                inverse_name='printer_id',
                                string='Paper Sources')
 
+    @api.model
+    def _cups_prefetch_calls(self, cups_printers):
+        calls = super(PrintingPrinter, self)._cups_prefetch_calls(
+            cups_printers)
+        for cups_printer in cups_printers.values():
+            printer_uri = cups_printer['printer-uri-supported']
+            printer_system_name = printer_uri[printer_uri.rfind('/') + 1:]
+            calls.append(('getPPD3', (printer_system_name,)))
+        return calls
+
     @api.multi
     def _prepare_update_from_cups(self, cups_connection, cups_printer):
         vals = super(PrintingPrinter, self)._prepare_update_from_cups(
@@ -72,26 +82,12 @@ class PrintingPrinter(models.Model):
     @api.multi
     def print_options(self, report=None, format=None, copies=1):
         """ Hook to define Tray """
-        printing_act_obj = self.env['printing.report.xml.action']
         options = super(PrintingPrinter, self).print_options(report, format)
 
         if report is not None:
-            # Retrieve report default values
-            if report.printer_tray_id:
-                tray = report.printer_tray_id
-            else:
-                # Retrieve user default values
-                tray = self.env.user.printer_tray_id
-
-            # Retrieve report-user specific values
-            action = printing_act_obj.search([
-                ('report_id', '=', report.id),
-                ('user_id', '=', self.env.uid),
-                ('action', '!=', 'user_default'),
-            ], limit=1)
-            if action.printer_tray_id:
-                tray = action.printer_tray_id
-
+            tray = self.env['printing.tray'].browse(
+                self.env['ir.actions.report.xml']._get_printer_tray_id(
+                    report.id))
             if tray:
                 options['InputSlot'] = str(tray.system_name)
 
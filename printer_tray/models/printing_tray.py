@@ -2,7 +2,7 @@
 # Copyright (C) 2013-2014 Camptocamp (<http://www.camptocamp.com>)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class PrinterTray(models.Model):
@@ -18,3 +18,9 @@ class PrinterTray(models.Model):
         readonly=True,
         ondelete='cascade',
     )
+
+    @api.multi
+    def unlink(self):
+        # The trays of the reports are cached
+        self.clear_caches()
+        return super(PrinterTray, self).unlink()
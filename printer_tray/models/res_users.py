@@ -18,3 +18,9 @@ class ResUsers(models.Model):
     def onchange_printing_printer_id(self):
         """ Reset the tray when the printer is changed """
         self.printer_tray_id = False
+
+    @api.model
+    def _printing_behaviour_fields(self):
+        return super(ResUsers, self)._printing_behaviour_fields() | {
+            'printer_tray_id',
+        }
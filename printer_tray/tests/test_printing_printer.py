@@ -6,6 +6,7 @@ import errno
 import mock
 import tempfile
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
 
 
 model = 'odoo.addons.base_report_to_printer.models.printing_printer'
@@ -37,6 +38,8 @@ class TestPrintingPrinter(TransactionCase):
 
     def setUp(self):
         super(TestPrintingPrinter, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['printing.printer']
         self.ServerModel = self.env['printing.server']
         self.server = self.env['printing.server'].create({})
@@ -179,6 +182,13 @@ class TestPrintingPrinter(TransactionCase):
         self.ServerModel.update_printers()
         self.assertEqual(self.printer.name, 'info')
 
+    def test_cups_prefetch_calls(self):
+        """ It should prefetch the PPD file of each printer """
+        calls = self.Model._cups_prefetch_calls({
+            'Printer': {'printer-uri-supported': 'ipp://localhost/Sys'},
+        })
+        self.assertEqual(calls, [('getPPD3', ('Sys',))])
+
     @mock.patch('%s.cups' % server_model)
     def test_prepare_update_from_cups_no_ppd(self, cups):
         """
@@ -183,6 +183,8 @@ class PrintingLabelZpl2(models.Model):
             # Send the label to printer
             label_contents = label._generate_zpl2_data(
                 record, page_count=page_count, **extra)
-            printer.print_document(None, label_contents, 'raw')
+            printer.print_document(
+                None, label_contents, 'raw', res_model=record._name,
+                res_ids=record.ids)
 
         return True
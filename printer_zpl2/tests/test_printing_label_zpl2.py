@@ -6,6 +6,7 @@ import mock
 
 from odoo import exceptions
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
 
 
 model = 'odoo.addons.base_report_to_printer.models.printing_server'
@@ -14,6 +15,8 @@ model = 'odoo.addons.base_report_to_printer.models.printing_server'
 class TestPrintingLabelZpl2(TransactionCase):
     def setUp(self):
         super(TestPrintingLabelZpl2, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['printing.label.zpl2']
         self.ComponentModel = self.env['printing.label.zpl2.component']
         self.server = self.env['printing.server'].create({})
@@ -58,9 +61,10 @@ class TestPrintingLabelZpl2(TransactionCase):
     @mock.patch('%s.cups' % model)
     def test_print_empty_label(self, cups):
         """ Check that printing an empty label works """
+        cups.Connection().createJob.return_value = 1
         label = self.new_label()
         label.print_label(self.printer, self.printer)
-        cups.Connection().printFile.assert_called_once()
+        cups.Connection().finishDocument.assert_called_once()
 
     def test_empty_label_contents(self):
         """ Check contents of an empty label """
@@ -5,6 +5,7 @@
 import mock
 
 from odoo.tests.common import TransactionCase
+from odoo.addons.base_report_to_printer.cups_connection import clear_pools
 
 
 model = 'odoo.addons.base_report_to_printer.models.printing_server'
@@ -13,6 +14,8 @@ model = 'odoo.addons.base_report_to_printer.models.printing_server'
 class TestWizardPrintRecordLabel(TransactionCase):
     def setUp(self):
         super(TestWizardPrintRecordLabel, self).setUp()
+        clear_pools()
+        self.addCleanup(clear_pools)
         self.Model = self.env['wizard.print.record.label']
         self.server = self.env['printing.server'].create({})
         self.printer = self.env['printing.printer'].create({
@@ -35,6 +38,7 @@ class TestWizardPrintRecordLabel(TransactionCase):
     @mock.patch('%s.cups' % model)
     def test_print_record_label(self, cups):
         """ Check that printing a label using the generic wizard works """
+        cups.Connection().createJob.return_value = 1
         wizard_obj = self.Model.with_context(
             active_model='printing.printer',
             active_id=self.printer.id,
@@ -44,7 +48,7 @@ class TestWizardPrintRecordLabel(TransactionCase):
         self.assertEqual(wizard.printer_id, self.printer)
         self.assertEqual(wizard.label_id, self.label)
         wizard.print_label()
-        cups.Connection().printFile.assert_called_once()
+        cups.Connection().finishDocument.assert_called_once()
 
     def test_wizard_multiple_printers_and_labels(self):
         """ Check that printer_id and label_id are not automatically filled